@@ -0,0 +1,366 @@
+"""Benchmark các bước xử lý ảnh của photobooth, chạy không cần camera và màn hình.
+
+Dùng ảnh giả và template/ảnh mẫu do photobooth tự tạo trong một thư mục tạm,
+Qt chạy với platform "offscreen". Mỗi bước được đo ở nhiều độ phân giải,
+báo cáo percentile độ trễ (ms) và mức tăng RSS đỉnh khi chạy, ghi kết quả JSON.
+RSS (không phải tracemalloc) để tính cả buffer của OpenCV/Qt; cần psutil hoặc /proc.
+
+Ví dụ:
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --threshold 0.2   # báo lỗi nếu chậm hơn 20%
+"""
+
+import os
+import sys
+import json
+import time
+import ctypes
+import argparse
+import platform
+import tempfile
+import threading
+
+# Phải đặt trước khi tạo QApplication
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import cv2
+import numpy as np
+from PyQt5.QtCore import QSize, QT_VERSION_STR
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtWidgets import QApplication
+
+import photobooth as pb
+
+try:
+    import psutil
+except ImportError:  # Tùy chọn: không có thì đọc /proc (Linux)
+    psutil = None
+
+# ==========================================
+# CẤU HÌNH (CONFIGURATION)
+# ==========================================
+SIZES = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "print": (1800, 1200),  # Giấy 4x6 inch @ 300 DPI
+}
+DISPLAY_SIZE = QSize(800, 450)  # Khung camera trên màn hình chụp
+DEFAULT_ITERATIONS = 30
+DEFAULT_WARMUP = 3
+PERCENTILES = (50, 90, 99)
+RSS_SAMPLE_INTERVAL = 0.001  # Giây giữa các lần lấy mẫu RSS khi đo bộ nhớ
+
+# ==========================================
+# DỮ LIỆU GIẢ (SYNTHETIC DATA)
+# ==========================================
+
+def synthetic_frame(size, seed=0):
+    """Frame BGR giả có gradient, nhiễu và vài hình khối (để JPEG/resize có chi tiết như ảnh thật)."""
+    w, h = size
+    rng = np.random.default_rng(seed)
+    frame = np.empty((h, w, 3), dtype=np.uint8)
+    frame[:, :, 0] = np.linspace(30, 220, w, dtype=np.float32)[None, :]
+    frame[:, :, 1] = np.linspace(60, 180, h, dtype=np.float32)[:, None]
+    frame[:, :, 2] = 128
+    noise = rng.integers(0, 24, size=(h, w, 3), dtype=np.uint8)
+    cv2.add(frame, noise, dst=frame)
+    for i in range(6):
+        center = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+        color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+        cv2.circle(frame, center, max(8, h // 10), color, -1)
+    return frame
+
+def load_template(size):
+    """Template mẫu đầu tiên (BGRA) resize về size."""
+    path = sorted(os.listdir(pb.TEMPLATE_DIR))[0]
+    template = cv2.imread(os.path.join(pb.TEMPLATE_DIR, path), cv2.IMREAD_UNCHANGED)
+    return os.path.join(pb.TEMPLATE_DIR, path), cv2.resize(template, size, interpolation=cv2.INTER_AREA)
+
+# ==========================================
+# ĐO ĐẠC (MEASUREMENT)
+# ==========================================
+
+def percentile(sorted_values, p):
+    """Percentile p (0-100) theo nội suy tuyến tính trên danh sách đã sắp xếp."""
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def current_rss():
+    """RSS hiện tại của tiến trình (byte), None nếu không đo được trên hệ này."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def release_free_memory():
+    """Trả vùng nhớ đã free về hệ điều hành (glibc), để lần chạy đo RSS phải cấp phát lại thật."""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def peak_rss_growth(fn):
+    """Chạy fn một lần, lấy mẫu RSS trên luồng phụ; trả về mức tăng đỉnh so với trước khi chạy (KB)."""
+    release_free_memory()
+    base = current_rss()
+    if base is None:
+        return None
+    peak = base
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, current_rss())
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        fn()
+    finally:
+        done.set()
+        sampler.join()
+    peak = max(peak, current_rss())
+    return (peak - base) / 1024
+
+def measure(fn, iterations, warmup):
+    """Chạy fn nhiều lần: trả về thống kê thời gian (ms) và mức tăng RSS đỉnh (KB) của một lần chạy."""
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+
+    # Đo bộ nhớ riêng một lần vì luồng lấy mẫu làm nhiễu phép đo thời gian
+    peak = peak_rss_growth(fn)
+
+    stats = {
+        "iterations": iterations,
+        "mean_ms": sum(times) / len(times),
+        "min_ms": times[0],
+        "max_ms": times[-1],
+        "rss_peak_kb": peak,
+    }
+    for p in PERCENTILES:
+        stats[f"p{p}_ms"] = percentile(times, p)
+    return stats
+
+# ==========================================
+# CÁC BƯỚC (STAGES)
+# ==========================================
+
+def stage_compositor(size, ctx):
+    """Ghép template lên ảnh: overlay_images (dựng compositor mỗi lần) và compositor dùng lại."""
+    frame = synthetic_frame(size)
+    _, template = load_template(size)
+    compositor = pb.TemplateCompositor(template, size)
+    out = np.empty_like(frame)
+    return {
+        "overlay_images": lambda: pb.overlay_images(frame, template),
+        "compositor.composite": lambda: compositor.composite(frame, out=out),
+    }
+
+def stage_collage(size, ctx):
+    """Dựng collage 2 và 4 ảnh kèm template, như lúc in."""
+    photos = [synthetic_frame((1280, 720), seed=i) for i in range(4)]
+    template_path, _ = load_template(size)
+    canvases = {}
+
+    def render(count):
+        canvases[count] = pb.render_collage(photos[:count], count, size, ctx["template_cache"],
+                                            template_path, out=canvases.get(count))
+
+    return {
+        "render_collage.2": lambda: render(2),
+        "render_collage.4": lambda: render(4),
+    }
+
+def stage_convert(size, ctx):
+    """Chuyển ảnh sang Qt: convert_cv_qt cả ảnh và FrameConverter vừa khung hiển thị."""
+    frame = synthetic_frame(size)
+    converter = pb.FrameConverter()
+    return {
+        "convert_cv_qt": lambda: pb.convert_cv_qt(frame),
+        "frame_converter.to_pixmap": lambda: converter.to_pixmap(frame, DISPLAY_SIZE),
+    }
+
+def stage_jpeg(size, ctx):
+    """Lưu ảnh in: imwrite mặc định, file in theo cấu hình OutputEncoder và các lựa chọn lấy mẫu màu."""
+    frame = synthetic_frame(size)
+    path = os.path.join(pb.OUTPUT_DIR, "bench.jpg")
+    cases = {
+        "jpeg_save": lambda: cv2.imwrite(path, frame),
+        "output.print": lambda: pb.encode_output("print", frame, path, pb.jpeg_params()),
+    }
+    for sampling in pb.JPEG_SAMPLING_FACTORS:
+        params = pb.jpeg_params(sampling=sampling, optimize=True)
+        cases[f"output.jpeg{sampling}.optimize"] = (
+            lambda params=params: pb.encode_output("bench", frame, path, params))
+    return cases
+
+def stage_archive(size, ctx):
+    """Các bản phụ: lưu trữ PNG/WebP không mất dữ liệu và JPEG chia sẻ web."""
+    frame = synthetic_frame(size)
+    base = os.path.join(pb.OUTPUT_DIR, "bench")
+    web = pb.jpeg_params(pb.OUTPUT_WEB_QUALITY, "420", True)
+    return {
+        "output.archive.png": lambda: pb.encode_output("bench", frame, base + ".png",
+                                                       [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+        "output.archive.webp": lambda: pb.encode_output("bench", frame, base + ".webp",
+                                                        [cv2.IMWRITE_WEBP_QUALITY, 101]),
+        "output.web": lambda: pb.encode_output("bench", frame, base + "_web.jpg", web, 1024),
+    }
+
+def stage_qr(ctx):
+    """Tạo mã QR thanh toán: lần đầu (xóa cache) và lấy từ cache."""
+    content = pb.package_qr_content(next(iter(pb.PACKAGES)))
+
+    def uncached():
+        pb.qr_code_modules.cache_clear()
+        pb.generate_qr_code.cache_clear()
+        pb.generate_qr_code(content)
+
+    return {
+        "generate_qr_code.uncached": uncached,
+        "generate_qr_code.cached": lambda: pb.generate_qr_code(content),
+    }
+
+def stage_carousel(ctx):
+    """Vẽ một frame carousel (paintEvent) với gallery ảnh mẫu."""
+    widget = pb.CarouselPhotoWidget(thumbnail_cache=pb.ThumbnailCache(pb.CAROUSEL_THUMB_SIZE))
+    widget.resize(760, widget.minimumHeight())
+    widget.set_photos(pb.load_sample_photos())
+    target = QPixmap(widget.size())
+
+    def paint():
+        widget.update_scroll(1 / 60)
+        widget.render(target)
+
+    ctx["keep"].append(widget)
+    return {
+        "carousel.paint": paint,
+    }
+
+SIZED_STAGES = {
+    "compositor": stage_compositor,
+    "collage": stage_collage,
+    "convert": stage_convert,
+    "jpeg": stage_jpeg,
+    "archive": stage_archive,
+}
+UNSIZED_STAGES = {
+    "qr": stage_qr,
+    "carousel": stage_carousel,
+}
+
+# ==========================================
+# CHẠY VÀ SO SÁNH (RUN & COMPARE)
+# ==========================================
+
+def run(stages, sizes, iterations, warmup):
+    """Chạy các bước đã chọn, trả về danh sách kết quả."""
+    ctx = {"template_cache": pb.TemplateCache(), "keep": []}
+    ctx["template_cache"].refresh()
+    results = []
+
+    def record(stage, size_name, cases):
+        for name, fn in cases.items():
+            stats = measure(fn, iterations, warmup)
+            results.append(dict(stage=stage, case=name, size=size_name, **stats))
+            rss = "n/a" if stats["rss_peak_kb"] is None else f"{stats['rss_peak_kb']:.0f} KB"
+            print(f"{name:<28}{size_name:>7}  p50 {stats['p50_ms']:8.2f} ms  p90 {stats['p90_ms']:8.2f} ms"
+                  f"  p99 {stats['p99_ms']:8.2f} ms  rss +{rss:>10}", flush=True)
+
+    for stage in stages:
+        if stage in SIZED_STAGES:
+            for size_name in sizes:
+                record(stage, size_name, SIZED_STAGES[stage](SIZES[size_name], ctx))
+        else:
+            record(stage, "-", UNSIZED_STAGES[stage](ctx))
+    return results
+
+def compare(results, baseline, threshold):
+    """So p50 với baseline; trả về danh sách (case, size, cũ, mới) chậm hơn quá ngưỡng."""
+    old = {(r["case"], r["size"]): r["p50_ms"] for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        before = old.get((r["case"], r["size"]))
+        if before is not None and r["p50_ms"] > before * (1 + threshold):
+            regressions.append((r["case"], r["size"], before, r["p50_ms"]))
+    return regressions
+
+def main(argv=None):
+    all_stages = list(SIZED_STAGES) + list(UNSIZED_STAGES)
+    parser = argparse.ArgumentParser(description="Benchmark xử lý ảnh photobooth (không cần camera).")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP)
+    parser.add_argument("--stages", nargs="+", choices=all_stages, default=all_stages)
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--output", help="Ghi kết quả JSON vào file này")
+    parser.add_argument("--baseline", help="File JSON kết quả cũ để so sánh")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Tỉ lệ chậm hơn baseline (p50) bị coi là hồi quy, mặc định 0.2")
+    args = parser.parse_args(argv)
+
+    # Đường dẫn tính theo thư mục hiện tại trước khi chuyển sang thư mục tạm
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    app = QApplication.instance() or QApplication(sys.argv)  # noqa: F841 - cần cho QPixmap
+    # Các hàm của photobooth ghi thời gian vào perf_monitor: dùng bản riêng, không lẫn với kiosk
+    pb.perf_monitor = pb.PerfMonitor(log_file=os.devnull)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="photobooth-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            # Tạo template và ảnh mẫu giống lần chạy đầu của kiosk
+            pb.ensure_directories()
+            results = run(args.stages, args.sizes, args.iterations, args.warmup)
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "qt": QT_VERSION_STR,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Đã ghi kết quả: {output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for case, size, before, after in regressions:
+            print(f"HỒI QUY: {case} [{size}] p50 {before:.2f} ms -> {after:.2f} ms")
+        if regressions:
+            return 1
+        print("Không có hồi quy so với baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,30 @@
 import sys
 import os
-import cv2
 import time
+_IMPORT_START = time.perf_counter()  # Mốc tính thời gian khởi động (gồm cả import thư viện)
+import cv2
 import subprocess
+import shutil
+import threading
+import queue
+import itertools
+import logging
+import functools
+import hashlib
+import json
+import math
+import bisect
+import platform
+import contextlib
 import numpy as np
-import qrcode
-from io import BytesIO
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict, namedtuple
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QLabel, 
                              QPushButton, QVBoxLayout, QHBoxLayout, QScrollArea, 
                              QMessageBox, QFrame, QGridLayout, QStackedWidget,
                              QGraphicsOpacityEffect)
-from PyQt5.QtCore import Qt, QTimer, QSize, QPropertyAnimation, QPoint, QEasingCurve, QSequentialAnimationGroup, QParallelAnimationGroup
-from PyQt5.QtGui import QImage, QPixmap, QFont, QIcon
+from PyQt5.QtCore import Qt, QEvent, QTimer, QSize, QPropertyAnimation, QPoint, QEasingCurve, QSequentialAnimationGroup, QParallelAnimationGroup, QThread, QObject, pyqtSignal, QRectF
+from PyQt5.QtGui import QImage, QPixmap, QFont, QIcon, QPainter, QColor, QPen, QLinearGradient
 
 # ==========================================
 # CẤU HÌNH (CONFIGURATION)
@@ -20,13 +32,90 @@ from PyQt5.QtGui import QImage, QPixmap, QFont, QIcon
 WINDOW_TITLE = "Photobooth Cảm Ứng"
 WINDOW_WIDTH = 1200
 WINDOW_HEIGHT = 800
-CAMERA_INDEX = 0
+CAMERA_INDEX = 0  # Chỉ số camera, đường dẫn file video, hoặc "synthetic" (ảnh giả, không cần camera)
+# Các chế độ camera (rộng, cao, FPS) theo thứ tự ưu tiên; chế độ đầu tiên đạt FPS sẽ được chọn.
+# Thêm (1920, 1080, 30) lên đầu để xem trước/chụp 1080p (tốn ~2.25 lần CPU và bộ nhớ mỗi frame),
+# hoặc dùng CAMERA_STILL_MODE để chỉ chụp ở độ phân giải cao.
+CAMERA_MODES = [(1280, 720, 30), (640, 480, 30)]
+CAMERA_BUFFER_SIZE = 1  # Số frame driver giữ lại; 1 để ảnh không bị trễ so với đếm ngược
+CAMERA_PROBE_FRAMES = 8  # Số frame đọc để đo FPS khi dò chế độ
+# Chế độ hai luồng: xem trước ở độ phân giải thấp (CAMERA_MODES, ví dụ [(640, 360, 30)]),
+# ảnh giữ lại chụp ở độ phân giải cao khi đếm ngược về 0.
+CAMERA_STILL_MODE = None  # (rộng, cao) ảnh chụp, ví dụ (1920, 1080); camera tạm đổi chế độ khi chụp
+CAMERA_STILL_SOURCE = None  # Nguồn camera thứ hai cho ảnh chụp (chỉ số hoặc đường dẫn); None = dùng chung camera
+CAMERA_STILL_WARMUP = 3  # Số frame bỏ đi sau khi đổi chế độ (frame đầu thường tối hoặc còn kích thước cũ)
+CAMERA_RING_SIZE = 8  # Số frame cấp phát sẵn trong ring buffer của luồng camera (> BURST_BEFORE + 1)
+BURST_FRAMES = 5  # Số frame quanh mỗi deadline, giữ frame nét và đủ sáng nhất (1 = tắt; không dùng khi có ảnh độ phân giải cao riêng)
+BURST_BEFORE = 2  # Trong đó số frame ngay trước deadline (lấy lại từ ring buffer)
+BURST_MAX_AGE = 0.5  # Giây; frame trong ring cũ hơn thế (ví dụ trước lúc camera tạm dừng) không được dùng
+BURST_SCORE_WIDTH = 320  # Chiều rộng bản thu nhỏ dùng để chấm điểm
 FIRST_PHOTO_DELAY = 10  # Giây cho ảnh đầu tiên
 BETWEEN_PHOTO_DELAY = 7  # Giây giữa các ảnh
+COUNTDOWN_TICK_INTERVAL = 50  # ms giữa các lần cập nhật đếm ngược (số giây tính từ đồng hồ, không cộng dồn)
 PHOTOS_TO_TAKE = 10
+# Lưu ảnh chụp trong phiên: "array" = một mảng (N, H, W, 3) cấp phát sẵn,
+# "jpeg" = nén JPEG trong RAM, chỉ giải mã khi cần (tiết kiệm bộ nhớ khi tăng số ảnh/độ phân giải)
+CAPTURE_STORAGE = "array"
+CAPTURE_JPEG_QUALITY = 95
+PHOTO_THUMB_SIZE = (180, 100)  # Thumbnail trong lưới chọn ảnh
+BACKGROUND_WORKERS = 2  # Số luồng xử lý ảnh nền (thumbnail, ...)
 TEMPLATE_DIR = "templates"
 OUTPUT_DIR = "output"
 SAMPLE_PHOTOS_DIR = "sample_photos"
+PRINTER_BACKEND = "auto"  # "windows", "spool" hoặc "auto" (Windows dùng máy in thật, hệ khác dùng spool)
+PRINTER_SPOOL_DIR = "print_spool"  # Thư mục nhận file in của máy in giả
+PRINTER_POLL_INTERVAL = 30  # Giây giữa các lần dò lại máy in
+PRINT_MAX_RETRIES = 2  # Số lần thử gửi lại máy in khi lỗi
+PRINT_RETRY_DELAY = 2000  # ms chờ giữa các lần thử
+# File in luôn là JPEG trong OUTPUT_DIR và được ghi trước; bản lưu trữ và bản chia sẻ web
+# (tùy chọn) được mã hóa song song trong lúc file in đang được gửi tới máy in
+OUTPUT_JPEG_QUALITY = 95
+OUTPUT_JPEG_SAMPLING = "420"  # "444" (màu nét nhất), "422" hoặc "420" (file nhỏ, mã hóa nhanh nhất)
+OUTPUT_JPEG_OPTIMIZE = False  # Tối ưu bảng Huffman: file nhỏ hơn vài %, mã hóa chậm hơn
+OUTPUT_ARCHIVE_FORMAT = None  # None, "png" hoặc "webp" (không mất dữ liệu), lưu trong OUTPUT_DIR/archive
+OUTPUT_ARCHIVE_DIR = os.path.join(OUTPUT_DIR, "archive")
+OUTPUT_WEB_WIDTH = None  # Chiều rộng bản JPEG chia sẻ web trong OUTPUT_DIR/web (None = không tạo)
+OUTPUT_WEB_QUALITY = 80
+OUTPUT_WEB_DIR = os.path.join(OUTPUT_DIR, "web")
+OUTPUT_ENCODER_WORKERS = 2  # Số luồng mã hóa các bản phụ
+# Hiện template và vùng cắt của ô collage đè lên camera khi chụp (tắt mặc định, bật khi cần)
+LIVE_OVERLAY = False
+LIVE_OVERLAY_TEMPLATE = None  # Đường dẫn template cho overlay (None = template đầu tiên)
+LIVE_OVERLAY_DIM = 140  # Độ tối (0-255) của phần khung hình sẽ bị cắt bỏ
+PREVIEW_SIZE = (960, 540)  # Collage xem trước trên màn hình (rộng, cao)
+# Collage in, render từ ảnh gốc khi khách xác nhận in.
+# Đổi thành (1800, 1200) cho giấy 4x6 inch @ 300 DPI (template nên cùng tỉ lệ 3:2).
+PRINT_SIZE = (1920, 1080)
+
+# Bố cục collage: mỗi ô là (x, y, rộng, cao) theo tỉ lệ 0..1 của khung hình.
+# Ảnh được cắt giữa cho đúng tỉ lệ ô rồi resize vào ô.
+COLLAGE_LAYOUTS = {
+    2: [(0, 0, 0.5, 1), (0.5, 0, 0.5, 1)],
+    4: [(0, 0, 0.5, 0.5), (0.5, 0, 0.5, 0.5),
+        (0, 0.5, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)],
+    6: [(col / 3, row / 2, 1 / 3, 1 / 2) for row in range(2) for col in range(3)],
+    # Dải 4 ảnh dọc, dùng với kích thước dọc như (600, 1800) cho giấy 2x6 inch
+    "strip": [(0, i / 4, 1, 1 / 4) for i in range(4)],
+}
+TEMPLATE_THUMB_SIZE = (100, 80)  # Kích thước thumbnail nút chọn template
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"  # Thumbnail carousel lưu trên đĩa
+THUMBNAIL_CACHE_SIZE = 200  # Số thumbnail tối đa giữ trong RAM
+CAROUSEL_THUMB_SIZE = (204, 264)  # Vùng ảnh bên trong một ô carousel
+CAROUSEL_SCROLL_SPEED = 66  # Tốc độ trôi của carousel (px/giây)
+CAROUSEL_PRELOAD_TILES = 8  # Số ô đầu mỗi hàng carousel đọc sẵn lúc khởi động; các ô sau được đọc nền khi sắp hiện
+CAROUSEL_TILE_CACHE_SIZE = 16  # Số ô (QPixmap ~250 KB) vẽ sẵn giữ lại cho mỗi carousel, vài màn hình
+ANIMATION_INTERVAL = 16  # Chu kỳ đồng hồ animation dùng chung (ms), ~60 FPS
+
+# Tiết kiệm điện/CPU khi không chụp
+CAMERA_IDLE_MODE = "pause"  # "stream" (luôn đọc), "pause" (ngừng đọc, giữ camera mở), "release" (đóng camera, mở lại khi cần)
+IDLE_TIMEOUT = 60  # Số giây không có thao tác thì chuyển màn hình chờ sang chế độ tiết kiệm
+IDLE_ANIMATION_INTERVAL = 50  # Chu kỳ animation (ms) khi chờ lâu, ~20 FPS
+
+# Đo hiệu năng
+PERF_WINDOW = 300  # Số mẫu gần nhất giữ cho mỗi bước (overlay)
+PERF_LOG_FILE = "perf_sessions.jsonl"  # Mỗi phiên chụp ghi một dòng JSON thống kê thời gian
+PERF_OVERLAY_TAPS = 5  # Chạm liên tiếp vào góc trên bên trái để bật/tắt overlay (hoặc phím F12)
+PERF_OVERLAY_CORNER = 80  # Kích thước vùng góc nhận cử chỉ ẩn (px)
 
 # Cấu hình giá tiền
 PRICE_2_PHOTOS = "20.000 VNĐ"
@@ -35,6 +124,15 @@ PRICE_4_PHOTOS = "35.000 VNĐ"
 # Thông tin thanh toán (ví dụ: số tài khoản, momo, etc.)
 PAYMENT_INFO = "MOMO: 0123456789 - NGUYEN VAN A"
 QR_CONTENT = "https://momosv3.apimienphi.com/api/QRCode?phone=0123456789&amount=20000&note=ThanhToanPhotobooth"
+# Các gói chụp: số ảnh -> giá hiển thị và số tiền trong mã QR (mã QR được tạo sẵn lúc khởi động)
+# "layout" (tuỳ chọn) là khoá trong COLLAGE_LAYOUTS, mặc định là số ảnh; ví dụ "layout": "strip" cho gói 4 ảnh dạng dải
+PACKAGES = {
+    2: {"price": PRICE_2_PHOTOS, "amount": "20000"},
+    4: {"price": PRICE_4_PHOTOS, "amount": "35000"},
+}
+QR_PACKAGE_CONTENT = "https://momosv3.apimienphi.com/api/QRCode?phone=0123456789&amount={amount}&note=Photobooth{count}Anh"
+QR_SIZE = 300  # Kích thước ảnh QR (px)
+QR_CACHE_SIZE = 16  # Số mã QR giữ trong cache
 
 # ==========================================
 # HÀM HỖ TRỢ (HELPER FUNCTIONS)
@@ -82,74 +180,454 @@ def create_sample_photos():
         ((150, 200, 255), "Memory 8"),
     ]
     
+    # Hệ số tối dần theo hàng, tính một lần cho mọi ảnh
+    shade = 1 - np.arange(400)[:, None] / 400 * 0.5
+    
     for i, (color, text) in enumerate(colors):
-        img = np.zeros((400, 300, 3), dtype=np.uint8)
-        # Gradient background
-        for y in range(400):
-            ratio = y / 400
-            img[y, :] = (
-                int(color[0] * (1 - ratio * 0.5)),
-                int(color[1] * (1 - ratio * 0.5)),
-                int(color[2] * (1 - ratio * 0.5))
-            )
+        # Gradient background: tính một cột màu rồi trải ra toàn bộ chiều ngang
+        column = (shade * np.array(color)).astype(np.uint8)
+        img = np.ascontiguousarray(np.broadcast_to(column[:, None, :], (400, 300, 3)))
         # Add text
         cv2.putText(img, text, (50, 200), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
         cv2.putText(img, "Sample", (80, 250), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
         cv2.imwrite(os.path.join(SAMPLE_PHOTOS_DIR, f"sample_{i+1}.jpg"), img)
 
-def generate_qr_code(content, size=300):
-    """Tạo mã QR từ nội dung."""
+@functools.lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_code_modules(content):
+    """Ma trận module của mã QR (uint8: 0 = đen, 255 = trắng, gồm cả viền); gọi được từ luồng nền."""
+    # Import khi cần: qrcode chỉ dùng ở màn hình thanh toán
+    import qrcode
+    
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
         border=4,
     )
     qr.add_data(content)
     qr.make(fit=True)
-    
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    qr_img = qr_img.resize((size, size))
-    
-    # Convert PIL Image to QPixmap
-    buffer = BytesIO()
-    qr_img.save(buffer, format="PNG")
-    buffer.seek(0)
-    
-    q_img = QImage()
-    q_img.loadFromData(buffer.getvalue())
+    modules = np.array(qr.get_matrix(), dtype=bool)
+    return np.where(modules, 0, 255).astype(np.uint8)
+
+@functools.lru_cache(maxsize=QR_CACHE_SIZE)
+def generate_qr_code(content, size=QR_SIZE):
+    """Tạo mã QR từ nội dung (QPixmap size x size, cache theo nội dung và kích thước)."""
+    # Phóng to ma trận module bằng nearest-neighbor rồi bọc thẳng thành QImage xám,
+    # không qua ảnh PIL và vòng mã hóa/giải mã PNG
+    pixels = cv2.resize(qr_code_modules(content), (size, size), interpolation=cv2.INTER_NEAREST)
+    q_img = QImage(pixels.data, size, size, pixels.strides[0], QImage.Format_Grayscale8)
     return QPixmap.fromImage(q_img)
 
-def overlay_images(background, foreground):
-    """Ghép ảnh foreground (có alpha) lên background."""
-    bg_h, bg_w = background.shape[:2]
-    fg_h, fg_w = foreground.shape[:2]
+def package_qr_content(photo_count):
+    """Nội dung mã QR thanh toán của gói photo_count ảnh."""
+    return QR_PACKAGE_CONTENT.format(amount=PACKAGES[photo_count]["amount"], count=photo_count)
+
+class TemplateCompositor:
+    """Ghép template BGRA lên ảnh BGR uint8 bằng số nguyên, chỉ xử lý vùng có alpha.
+
+    Template được resize và premultiply một lần khi khởi tạo. Ảnh được chia
+    thành các ô tile x tile: ô trong suốt hoàn toàn bị bỏ qua, ô đục hoàn toàn
+    chỉ copy, ô có cùng màu và alpha (ví dụ lớp phủ tối) được blend bằng một
+    phép biến đổi tuyến tính, các ô còn lại được blend tại chỗ với buffer
+    uint16 dùng chung.
+    """
 
-    if (bg_w, bg_h) != (fg_w, fg_h):
-        foreground = cv2.resize(foreground, (bg_w, bg_h))
+    TRANSPARENT, BLEND, UNIFORM, OPAQUE = 0, 1, 2, 3
 
+    def __init__(self, template, size, tile=32):
+        w, h = size
+        self.size = (w, h)
+        self.regions = []  # (y0, y1, x0, x1, loại vùng, dữ liệu đã tính sẵn)
+        self.bbox = None   # (x, y, w, h) của vùng alpha > 0
+        self._lock = threading.Lock()
+
+        if template is None or template.ndim < 3 or template.shape[2] < 4:
+            self._scratch = np.empty(0, dtype=np.uint16)
+            return
+        if template.shape[:2] != (h, w):
+            template = cv2.resize(template, (w, h), interpolation=cv2.INTER_AREA)
+
+        ys = np.arange(0, h, tile)
+        xs = np.arange(0, w, tile)
+        tile_max = np.maximum.reduceat(np.maximum.reduceat(template, ys, axis=0), xs, axis=1)
+        tile_min = np.minimum.reduceat(np.minimum.reduceat(template, ys, axis=0), xs, axis=1)
+        a_max, a_min = tile_max[:, :, 3], tile_min[:, :, 3]
+        constant = np.all(tile_max == tile_min, axis=2)
+        kinds = np.full(a_max.shape, self.BLEND)
+        kinds[a_max == 0] = self.TRANSPARENT
+        kinds[a_min == 255] = self.OPAQUE
+        kinds[constant & (a_max > 0) & (a_max < 255)] = self.UNIFORM
+        # Ô UNIFORM chỉ gộp với ô kề bên có cùng màu và alpha
+        tile_key = np.where(kinds == self.UNIFORM,
+                            tile_max.astype(np.int64) @ (1 << np.arange(0, 32, 8, dtype=np.int64)), -1)
+
+        max_elems = 0
+        for ty, y0 in enumerate(ys):
+            y1 = min(y0 + tile, h)
+            tx = 0
+            while tx < len(xs):
+                kind, key = kinds[ty, tx], tile_key[ty, tx]
+                start = tx
+                while tx < len(xs) and kinds[ty, tx] == kind and tile_key[ty, tx] == key:
+                    tx += 1
+                if kind == self.TRANSPARENT:
+                    continue
+                x0, x1 = int(xs[start]), int(min(xs[tx - 1] + tile, w))
+                fg = template[y0:y1, x0:x1, :3]
+                if kind == self.OPAQUE:
+                    data = fg.copy()
+                elif kind == self.UNIFORM:
+                    # out = bg * (255 - a) / 255 + màu * a / 255 cho từng kênh
+                    a = float(tile_max[ty, start, 3])
+                    data = np.zeros((3, 4), dtype=np.float32)
+                    data[[0, 1, 2], [0, 1, 2]] = (255 - a) / 255
+                    data[:, 3] = tile_max[ty, start, :3] * a / 255
+                else:
+                    a = np.repeat(template[y0:y1, x0:x1, 3:4], 3, axis=2).astype(np.uint16)
+                    data = (fg.astype(np.uint16) * a, 255 - a)
+                    max_elems = max(max_elems, fg.size)
+                self.regions.append((int(y0), int(y1), x0, x1, kind, data))
+
+        if self.regions:
+            ys_nz, xs_nz = np.nonzero(a_max)
+            bx0, by0 = int(xs[xs_nz.min()]), int(ys[ys_nz.min()])
+            bx1 = min(int(xs[xs_nz.max()]) + tile, w)
+            by1 = min(int(ys[ys_nz.max()]) + tile, h)
+            self.bbox = (bx0, by0, bx1 - bx0, by1 - by0)
+
+        # Buffer trung gian dùng chung cho mọi vùng, cấp phát một lần
+        self._scratch = np.empty(max_elems, dtype=np.uint16)
+
+    def composite(self, background, out=None):
+        """Ghép template lên background, ghi vào out (tạo mới nếu None hoặc sai kích thước).
+
+        Truyền out=background để ghép trực tiếp tại chỗ.
+        """
+        if background.shape[1::-1] != self.size:
+            raise ValueError(f"Kích thước ảnh {background.shape[1::-1]} khác template {self.size}")
+        if out is None or out.shape != background.shape:
+            out = background.copy()
+        elif out is not background:
+            np.copyto(out, background)
+
+        with self._lock:
+            for y0, y1, x0, x1, kind, data in self.regions:
+                roi = out[y0:y1, x0:x1]
+                if kind == self.OPAQUE:
+                    roi[...] = data
+                elif kind == self.UNIFORM:
+                    cv2.transform(roi, data, dst=roi)
+                else:
+                    premul, inv_alpha = data
+                    acc = self._scratch[:premul.size].reshape(premul.shape)
+                    # acc = fg * a + bg * (255 - a), tối đa 255 * 255 nên vừa uint16
+                    cv2.multiply(roi, inv_alpha, dst=acc, dtype=cv2.CV_16U)
+                    cv2.add(acc, premul, dst=acc)
+                    # Chia 255 có làm tròn, ghi thẳng về uint8
+                    cv2.convertScaleAbs(acc, dst=roi, alpha=1 / 255)
+        return out
+
+class CollageLayout:
+    """Bố cục collage đã biên dịch cho một kích thước đầu ra.
+
+    Toạ độ pixel của từng ô được tính một lần; vùng crop và kiểu nội suy cho
+    mỗi kích thước ảnh nguồn được cache lại. Khi render, ảnh được resize thẳng
+    vào view của canvas nên không cấp phát mảng nào cho từng ảnh.
+    """
+
+    def __init__(self, slots, size):
+        w, h = size
+        self.size = (w, h)
+        self.slots = []  # (x0, y0, x1, y1) theo pixel
+        for fx, fy, fw, fh in slots:
+            x0, y0 = int(round(fx * w)), int(round(fy * h))
+            x1, y1 = int(round((fx + fw) * w)), int(round((fy + fh) * h))
+            self.slots.append((x0, y0, x1, y1))
+        self._plans = {}  # (chỉ số ô, rộng nguồn, cao nguồn) -> (crop, interpolation)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def slot_size(self, index):
+        """Kích thước (rộng, cao) của ô index."""
+        x0, y0, x1, y1 = self.slots[index]
+        return x1 - x0, y1 - y0
+
+    def plan(self, index, src_w, src_h):
+        """Vùng crop giữa (x0, y0, x1, y1) của ảnh nguồn theo tỉ lệ ô và kiểu nội suy."""
+        key = (index, src_w, src_h)
+        plan = self._plans.get(key)
+        if plan is None:
+            slot_w, slot_h = self.slot_size(index)
+            crop_w = min(src_w, int(round(src_h * slot_w / slot_h)))
+            crop_h = min(src_h, int(round(src_w * slot_h / slot_w)))
+            cx0 = (src_w - crop_w) // 2
+            cy0 = (src_h - crop_h) // 2
+            interpolation = resize_interpolation(crop_w, slot_w)
+            plan = ((cx0, cy0, cx0 + crop_w, cy0 + crop_h), interpolation)
+            self._plans[key] = plan
+        return plan
+
+    def render_slot(self, image, index, out=None):
+        """Crop và resize ảnh cho ô index, ghi vào out nếu có."""
+        src_h, src_w = image.shape[:2]
+        (cx0, cy0, cx1, cy1), interpolation = self.plan(index, src_w, src_h)
+        return cv2.resize(image[cy0:cy1, cx0:cx1], self.slot_size(index), dst=out,
+                          interpolation=interpolation)
+
+    def slot_view(self, canvas, index):
+        """View của canvas ứng với ô index."""
+        x0, y0, x1, y1 = self.slots[index]
+        return canvas[y0:y1, x0:x1]
+
+    def compose(self, slot_images, out=None):
+        """Ghép các ảnh đã resize sẵn đúng kích thước ô (xem render_slot) vào canvas."""
+        if len(slot_images) != len(self.slots):
+            raise ValueError(f"Bố cục cần {len(self.slots)} ảnh, nhận {len(slot_images)}")
+        w, h = self.size
+        if out is None or out.shape != (h, w, 3):
+            out = np.zeros((h, w, 3), dtype=np.uint8)
+        for index, image in enumerate(slot_images):
+            np.copyto(self.slot_view(out, index), image)
+        return out
+
+    def render(self, images, out=None):
+        """Ghép các ảnh vào canvas; tái sử dụng out nếu đúng kích thước."""
+        if len(images) != len(self.slots):
+            raise ValueError(f"Bố cục cần {len(self.slots)} ảnh, nhận {len(images)}")
+        w, h = self.size
+        if out is None or out.shape != (h, w, 3):
+            out = np.zeros((h, w, 3), dtype=np.uint8)
+        for index, image in enumerate(images):
+            self.render_slot(image, index, out=self.slot_view(out, index))
+        return out
+
+_compiled_layouts = {}
+
+def get_collage_layout(key, size=PREVIEW_SIZE):
+    """Bố cục đã biên dịch cho key (số ảnh hoặc tên) ở kích thước size, chỉ biên dịch một lần."""
+    layout = _compiled_layouts.get((key, size))
+    if layout is None:
+        if key not in COLLAGE_LAYOUTS:
+            raise ValueError(f"Không có bố cục collage cho: {key}")
+        layout = CollageLayout(COLLAGE_LAYOUTS[key], size)
+        _compiled_layouts[(key, size)] = layout
+    return layout
+
+def render_collage(images, layout_key, size, template_cache=None, template_path=None, out=None):
+    """Render collage và template (nếu có) ở kích thước size; dùng cho cả preview lẫn bản in."""
+    canvas = get_collage_layout(layout_key, size).render(images, out=out)
+    if template_cache is not None and template_path:
+        compositor = template_cache.compositor(template_path, size)
+        if compositor is not None:
+            compositor.composite(canvas, out=canvas)
+    return canvas
+
+def prepare_slot_images(image, layout):
+    """Resize sẵn một ảnh cho mọi kích thước ô khác nhau của bố cục: {(rộng, cao): ảnh}."""
+    prepared = {}
+    for index in range(len(layout)):
+        size = layout.slot_size(index)
+        if size not in prepared:
+            prepared[size] = layout.render_slot(image, index)
+    return prepared
+
+def build_live_overlay(size, layout, template=None, dim=LIVE_OVERLAY_DIM):
+    """Tạo compositor overlay cho camera: làm tối phần bị cắt khỏi ô và đặt template vào vùng giữ lại.
+
+    Overlay được dựng một lần ở kích thước hiển thị; mỗi frame chỉ blend các
+    dải viền nên đủ nhanh để chạy ở tốc độ camera.
+    """
+    w, h = size
+    overlay = np.zeros((h, w, 4), dtype=np.uint8)
+    (x0, y0, x1, y1), _ = layout.plan(0, w, h)
+    overlay[:, :, 3] = dim
+    overlay[y0:y1, x0:x1, 3] = 0
+    if template is not None and template.ndim == 3 and template.shape[2] == 4:
+        # Chỉ phần template phủ lên ô 0 trong collage, để khách thấy đúng như bản in
+        th, tw = template.shape[:2]
+        lw, lh = layout.size
+        sx0, sy0, sx1, sy1 = layout.slots[0]
+        tx0, ty0 = sx0 * tw // lw, sy0 * th // lh
+        tx1, ty1 = max(tx0 + 1, sx1 * tw // lw), max(ty0 + 1, sy1 * th // lh)
+        crop_w = x1 - x0
+        overlay[y0:y1, x0:x1] = cv2.resize(template[ty0:ty1, tx0:tx1], (crop_w, y1 - y0),
+                                           interpolation=resize_interpolation(tx1 - tx0, crop_w))
+    return TemplateCompositor(overlay, size)
+
+def render_template_previews(slot_images, layout, template_cache, template_paths):
+    """Dựng collage từ các ảnh ô có sẵn và bản ghép với từng template: (collage, {path: ảnh})."""
+    with perf_monitor.timer("render.template_previews"):
+        collage = layout.compose(slot_images)
+        merged = {}
+        for path in template_paths:
+            compositor = template_cache.compositor(path, layout.size)
+            if compositor is not None:
+                merged[path] = compositor.composite(collage)
+    return collage, merged
+
+class TemplateCache:
+    """Cache template: giải mã mỗi PNG một lần, giữ compositor theo kích thước và thumbnail.
+
+    Mỗi mục gắn với mtime của file; refresh() chỉ stat thư mục và giải mã lại
+    những file mới hoặc đã bị sửa, nên đổi template không tốn I/O hay resize.
+    """
+
+    def __init__(self, template_dir=TEMPLATE_DIR, thumb_size=TEMPLATE_THUMB_SIZE):
+        self.template_dir = template_dir
+        self.thumb_size = thumb_size
+        self._entries = {}  # path -> {"mtime", "image", "compositors", "thumbnail"}
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Quét lại thư mục template và trả về danh sách đường dẫn hợp lệ."""
+        found = {}
+        if os.path.exists(self.template_dir):
+            for f in sorted(os.listdir(self.template_dir)):
+                if f.lower().endswith('.png'):
+                    path = os.path.join(self.template_dir, f)
+                    try:
+                        found[path] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        continue
+
+        with self._lock:
+            for path in list(self._entries):
+                if path not in found:
+                    del self._entries[path]
+            for path, mtime in found.items():
+                entry = self._entries.get(path)
+                if entry is not None and entry["mtime"] == mtime:
+                    continue
+                image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                if image is None or image.ndim < 3:
+                    self._entries.pop(path, None)
+                    continue
+                self._entries[path] = {
+                    "mtime": mtime,
+                    "image": image,
+                    "compositors": {},
+                    "thumbnail": None,
+                }
+            return list(self._entries)
+
+    def image(self, path):
+        """Ảnh template đã giải mã (BGRA), None nếu không có."""
+        with self._lock:
+            entry = self._entries.get(path)
+            return None if entry is None else entry["image"]
+
+    def paths(self):
+        """Danh sách template đang có trong cache."""
+        with self._lock:
+            return list(self._entries)
+
+    def compositor(self, path, size):
+        """TemplateCompositor của template ở kích thước size (w, h), tạo một lần rồi dùng lại."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return None
+            compositor = entry["compositors"].get(size)
+            if compositor is None:
+                compositor = TemplateCompositor(entry["image"], size)
+                entry["compositors"][size] = compositor
+            return compositor
+
+    def preload(self, size):
+        """Tạo sẵn compositor cho mọi template ở kích thước size."""
+        for path in self.paths():
+            self.compositor(path, size)
+
+    def thumbnail(self, path):
+        """Thumbnail QPixmap của template (chỉ gọi trên luồng GUI)."""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return QPixmap()
+            if entry["thumbnail"] is None:
+                image = entry["image"]
+                if image.shape[2] == 3:
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+                h, w = image.shape[:2]
+                scale = min(self.thumb_size[0] / w, self.thumb_size[1] / h)
+                tw, th = max(1, int(w * scale)), max(1, int(h * scale))
+                thumb = np.ascontiguousarray(cv2.resize(image, (tw, th), interpolation=cv2.INTER_AREA))
+                # BGRA trong bộ nhớ chính là QImage.Format_ARGB32 trên máy little-endian
+                q_img = QImage(thumb.data, tw, th, thumb.strides[0], QImage.Format_ARGB32)
+                entry["thumbnail"] = QPixmap.fromImage(q_img)
+            return entry["thumbnail"]
+
+def overlay_images(background, foreground):
+    """Ghép ảnh foreground (có alpha) lên background."""
     if foreground.shape[2] < 4:
         return background
-    
-    alpha = foreground[:, :, 3] / 255.0
-    output = np.zeros_like(background)
-    
-    for c in range(0, 3):
-        output[:, :, c] = (foreground[:, :, c] * alpha + 
-                           background[:, :, c] * (1.0 - alpha))
-    
-    return output
+    bg_h, bg_w = background.shape[:2]
+    return TemplateCompositor(foreground, (bg_w, bg_h)).composite(background)
+
+# Qt >= 5.14 đọc được thẳng buffer BGR của OpenCV, không cần đổi sang RGB
+HAS_BGR888 = hasattr(QImage, "Format_BGR888")
 
 def convert_cv_qt(cv_img):
     """Chuyển đổi ảnh OpenCV sang QPixmap."""
     if cv_img is None:
         return QPixmap()
+    if HAS_BGR888:
+        bgr_image = np.ascontiguousarray(cv_img)
+        h, w = bgr_image.shape[:2]
+        qt_format = QImage(bgr_image.data, w, h, bgr_image.strides[0], QImage.Format_BGR888)
+        return QPixmap.fromImage(qt_format)
     rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
     h, w, ch = rgb_image.shape
     bytes_per_line = ch * w
     qt_format = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
     return QPixmap.fromImage(qt_format)
 
+def resize_interpolation(src_w, dst_w):
+    """INTER_AREA chỉ khi thu nhỏ mạnh (>= 2 lần); với tỉ lệ lẻ nhẹ hơn INTER_LINEAR nhanh hơn nhiều."""
+    return cv2.INTER_AREA if dst_w * 2 <= src_w else cv2.INTER_LINEAR
+
+def fit_size(src_w, src_h, target_w, target_h):
+    """Kích thước lớn nhất vừa khung target mà vẫn giữ tỉ lệ ảnh nguồn."""
+    scale = min(target_w / src_w, target_h / src_h)
+    return max(1, int(src_w * scale)), max(1, int(src_h * scale))
+
+class FrameConverter:
+    """Chuyển ảnh BGR sang QPixmap vừa một khung hiển thị, dùng lại buffer cấp phát sẵn.
+
+    Ảnh được cv2.resize thẳng vào buffer đúng kích thước hiển thị rồi bọc
+    bằng QImage (BGR888 nếu Qt hỗ trợ, nếu không thì qua một buffer RGB dùng
+    lại), nên mỗi frame chỉ còn một lần copy khi tạo QPixmap.
+    """
+
+    def __init__(self):
+        self._buffer = None
+        self._rgb = None
+
+    def resize(self, image, target_w, target_h):
+        """Resize image vào buffer nội bộ cho vừa khung (target_w, target_h); trả về buffer."""
+        src_h, src_w = image.shape[:2]
+        w, h = fit_size(src_w, src_h, target_w, target_h)
+        if self._buffer is None or self._buffer.shape != (h, w, 3):
+            self._buffer = np.empty((h, w, 3), dtype=np.uint8)
+        return cv2.resize(image, (w, h), dst=self._buffer,
+                          interpolation=resize_interpolation(src_w, w))
+
+    def wrap(self, bgr):
+        """Bọc buffer BGR liền mạch thành QPixmap."""
+        h, w = bgr.shape[:2]
+        if HAS_BGR888:
+            q_img = QImage(bgr.data, w, h, bgr.strides[0], QImage.Format_BGR888)
+        else:
+            if self._rgb is None or self._rgb.shape != bgr.shape:
+                self._rgb = np.empty_like(bgr)
+            cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self._rgb)
+            q_img = QImage(self._rgb.data, w, h, self._rgb.strides[0], QImage.Format_RGB888)
+        return QPixmap.fromImage(q_img)
+
+    def to_pixmap(self, image, size):
+        """QPixmap của image thu nhỏ vừa size (QSize), giữ tỉ lệ."""
+        return self.wrap(self.resize(image, size.width(), size.height()))
+
 def check_printer_available():
     """Kiểm tra xem có máy in nào được kết nối không (Windows)."""
     if os.name != 'nt':
@@ -185,112 +663,1683 @@ def load_sample_photos():
                 photos.append(os.path.join(OUTPUT_DIR, f))
     return photos
 
+class GalleryIndex:
+    """Danh sách ảnh gallery: quét thư mục một lần lúc khởi động, sau đó chỉ nối thêm ảnh mới."""
+
+    def __init__(self):
+        self.photos = load_sample_photos()
+        self._known = set(self.photos)
+
+    def add(self, path):
+        """Thêm một ảnh vào cuối gallery; trả về False nếu ảnh đã có."""
+        if path in self._known:
+            return False
+        self._known.add(path)
+        self.photos.append(path)
+        return True
+
+# ==========================================
+# ĐO HIỆU NĂNG (PERFORMANCE MONITOR)
+# ==========================================
+
+logger = logging.getLogger("photobooth")
+
+class PerfMonitor:
+    """Thống kê thời gian (ms) các bước nóng, gọi được từ mọi luồng.
+
+    Mỗi bước giữ một cửa sổ trượt window mẫu gần nhất cho overlay; trong một
+    phiên chụp mọi mẫu còn được gom lại để end_session() ghi một dòng JSON
+    (percentile và histogram) vào log_file. Mẫu mặc định thuộc phiên mới nhất;
+    việc của phiên cũ còn chạy nền (ví dụ job in) truyền session để ghi đúng phiên.
+    """
+
+    BUCKETS = (1, 2, 4, 8, 16, 33, 66, 133, 266)  # Cận trên các ô histogram (ms), ô cuối là > 266
+
+    def __init__(self, window=PERF_WINDOW, log_file=PERF_LOG_FILE):
+        self.window = window
+        self.log_file = log_file
+        self._lock = threading.Lock()
+        self._recent = {}  # tên bước -> deque các mẫu gần nhất
+        self._marks = {}   # tên -> thời điểm mark() trước
+        self._sessions = {}  # mã phiên -> dữ liệu các phiên chưa đóng
+        self._current = None  # mã phiên mới nhất
+
+    def record(self, name, ms, session=None):
+        """Ghi một mẫu thời gian ms cho bước name (vào phiên session, mặc định phiên mới nhất)."""
+        with self._lock:
+            samples = self._recent.get(name)
+            if samples is None:
+                samples = self._recent[name] = deque(maxlen=self.window)
+            samples.append(ms)
+            target = self._sessions.get(self._current if session is None else session)
+            if target is not None:
+                target["samples"].setdefault(name, []).append(ms)
+
+    @contextlib.contextmanager
+    def timer(self, name, session=None):
+        """Đo thời gian khối lệnh with và ghi vào bước name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000, session)
+
+    def mark(self, name):
+        """Ghi khoảng cách giữa hai lần gọi (bước name + ".interval"), dùng để tính FPS."""
+        now = time.perf_counter()
+        last = self._marks.get(name)
+        self._marks[name] = now
+        if last is not None:
+            self.record(name + ".interval", (now - last) * 1000)
+
+    @classmethod
+    def summarize(cls, samples):
+        """Thống kê một dãy mẫu: số lượng, trung bình, p50/p90/p99, max và histogram."""
+        values = np.asarray(samples, dtype=np.float64)
+        p50, p90, p99 = np.percentile(values, (50, 90, 99))
+        histogram = [0] * (len(cls.BUCKETS) + 1)
+        for value in samples:
+            histogram[bisect.bisect_left(cls.BUCKETS, value)] += 1
+        return {
+            "count": len(samples),
+            "mean": round(float(values.mean()), 3),
+            "p50": round(float(p50), 3),
+            "p90": round(float(p90), 3),
+            "p99": round(float(p99), 3),
+            "max": round(float(values.max()), 3),
+            "histogram": histogram,
+        }
+
+    def snapshot(self):
+        """Thống kê cửa sổ gần nhất của mọi bước: {tên: thống kê}."""
+        with self._lock:
+            recent = {name: list(samples) for name, samples in self._recent.items() if samples}
+        return {name: self.summarize(samples) for name, samples in sorted(recent.items())}
+
+    def fps(self, name):
+        """FPS từ khoảng cách trung vị giữa các lần mark(name), 0 nếu chưa đủ mẫu."""
+        with self._lock:
+            samples = list(self._recent.get(name + ".interval", ()))
+        if not samples:
+            return 0.0
+        median = float(np.median(samples))
+        return 1000 / median if median > 0 else 0.0
+
+    def begin_session(self, session_id, **info):
+        """Bắt đầu gom mẫu cho một phiên chụp; phiên trước vẫn mở cho tới khi end_session(mã của nó)."""
+        with self._lock:
+            self._sessions[session_id] = {"session": session_id, "started": time.time(), "info": info,
+                                          "samples": {}}
+            self._current = session_id
+
+    def end_session(self, session_id, **info):
+        """Kết thúc phiên, ghi một dòng JSON vào log_file; trả về bản ghi hoặc None nếu phiên đã đóng."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session_id == self._current:
+                self._current = None
+        if session is None:
+            return None
+        ended = time.time()
+        record = {
+            "session": session["session"],
+            "host": platform.node(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(session["started"])),
+            "duration_s": round(ended - session["started"], 1),
+            "buckets_ms": list(self.BUCKETS),
+            **session["info"],
+            **info,
+            "stages": {name: self.summarize(samples) for name, samples in sorted(session["samples"].items())},
+        }
+        try:
+            with open(self.log_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            logger.warning("Không ghi được log hiệu năng %s: %s", self.log_file, e)
+        return record
+
+perf_monitor = PerfMonitor()
+
+# ==========================================
+# CẤU HÌNH CAMERA (CAMERA SETUP)
+# ==========================================
+
+CameraMode = namedtuple("CameraMode", "width height fps fourcc measured_fps")
+
+class SyntheticCamera:
+    """Camera giả tạo ảnh động theo FPS cố định, cùng giao diện với cv2.VideoCapture."""
+
+    def __init__(self, width=1280, height=720, fps=30):
+        self.width, self.height, self.fps = width, height, fps
+        self._index = 0
+        self._next_time = time.monotonic()
+        self._background = None
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        elif prop == cv2.CAP_PROP_FPS:
+            self.fps = float(value)
+        else:
+            return False
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return 0.0
+
+    def grab(self):
+        # Giữ nhịp FPS như camera thật
+        now = time.monotonic()
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+        self._next_time = max(now, self._next_time) + 1.0 / self.fps
+        self._index += 1
+        return True
+
+    def retrieve(self, image=None):
+        shape = (self.height, self.width, 3)
+        if self._background is None or self._background.shape != shape:
+            ramp_x = np.linspace(40, 200, self.width, dtype=np.float32)
+            ramp_y = np.linspace(60, 160, self.height, dtype=np.float32)
+            self._background = np.empty(shape, dtype=np.uint8)
+            self._background[:, :, 0] = ramp_x[None, :]
+            self._background[:, :, 1] = ramp_y[:, None]
+            self._background[:, :, 2] = 120
+        if image is None or image.shape != shape:
+            image = np.empty(shape, dtype=np.uint8)
+        np.copyto(image, self._background)
+        cx = int((self._index * 8) % self.width)
+        cv2.circle(image, (cx, self.height // 2), self.height // 8, (255, 255, 255), -1)
+        cv2.putText(image, f"#{self._index}", (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 3)
+        return True, image
+
+    def read(self, image=None):
+        return self.retrieve(image) if self.grab() else (False, None)
+
+class VideoFileCamera:
+    """Phát lại file video lặp vô hạn theo FPS của file, thay cho camera khi thử nghiệm."""
+
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and fps > 0 else 30.0
+        self._next_time = time.monotonic()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def release(self):
+        self.cap.release()
+
+    def set(self, prop, value):
+        # Độ phân giải của file cố định
+        return False
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def grab(self):
+        now = time.monotonic()
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+        self._next_time = max(now, self._next_time) + 1.0 / self.fps
+
+        if self.cap.grab():
+            return True
+        # Hết file: quay lại đầu
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self.cap.grab()
+
+    def retrieve(self, image=None):
+        return self.cap.retrieve(image) if image is not None else self.cap.retrieve()
+
+    def read(self, image=None):
+        return self.retrieve(image) if self.grab() else (False, None)
+
+def fourcc_to_str(value):
+    """Đổi mã FOURCC dạng số của OpenCV sang chuỗi 4 ký tự."""
+    value = int(value)
+    if value <= 0:
+        return ""
+    return "".join(chr((value >> (8 * i)) & 0xFF) for i in range(4))
+
+def measure_camera_fps(cap, frames=CAMERA_PROBE_FRAMES):
+    """Đo FPS thực tế bằng cách đọc liên tiếp vài frame (bỏ frame đầu để làm nóng)."""
+    cap.read()
+    start = time.monotonic()
+    count = 0
+    for _ in range(frames):
+        ok, _ = cap.read()
+        count += bool(ok)
+    elapsed = time.monotonic() - start
+    return count / elapsed if count and elapsed > 0 else 0.0
+
+def negotiate_camera_mode(cap, modes=CAMERA_MODES):
+    """Chọn chế độ camera đầu tiên đạt FPS yêu cầu, thử MJPEG khi định dạng mặc định quá chậm.
+
+    Nhiều webcam USB mặc định dùng YUYV không nén, chỉ đạt 5-10 FPS ở 720p/1080p;
+    chuyển FOURCC sang MJPG thường đưa về 30 FPS. Nếu không chế độ nào đạt,
+    chọn chế độ có FPS đo được cao nhất.
+    """
+    best = None
+    default_fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+
+    def set_fourcc(fourcc):
+        if fourcc:
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        elif default_fourcc > 0:
+            # MJPG của lần thử trước vẫn còn hiệu lực: trả về định dạng mặc định
+            cap.set(cv2.CAP_PROP_FOURCC, default_fourcc)
+
+    for width, height, fps in modes:
+        for fourcc in (None, "MJPG"):
+            set_fourcc(fourcc)
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            cap.set(cv2.CAP_PROP_FPS, fps)
+            actual = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            if actual != (width, height):
+                # Có camera chỉ hỗ trợ độ phân giải này ở MJPG: thử định dạng tiếp theo
+                continue
+            measured = measure_camera_fps(cap)
+            mode = CameraMode(width, height, fps, fourcc_to_str(cap.get(cv2.CAP_PROP_FOURCC)),
+                              round(measured, 1))
+            if measured >= fps * 0.9:
+                return mode
+            if best is None or measured > best[0].measured_fps:
+                best = (mode, fourcc)
+
+    if best is None:
+        # Camera không nhận chế độ nào: giữ nguyên chế độ hiện tại
+        return CameraMode(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                          cap.get(cv2.CAP_PROP_FPS), fourcc_to_str(cap.get(cv2.CAP_PROP_FOURCC)),
+                          round(measure_camera_fps(cap), 1))
+    mode, fourcc = best
+    set_fourcc(fourcc)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, mode.width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, mode.height)
+    cap.set(cv2.CAP_PROP_FPS, mode.fps)
+    return mode
+
+def open_camera(source=CAMERA_INDEX, modes=CAMERA_MODES, buffer_size=CAMERA_BUFFER_SIZE):
+    """Mở nguồn camera (chỉ số, file video hoặc "synthetic") và dò chế độ; trả về (cap, CameraMode hoặc None)."""
+    if source == "synthetic":
+        cap = SyntheticCamera()
+    elif isinstance(source, str) and not source.isdigit():
+        cap = VideoFileCamera(source)
+    else:
+        cap = cv2.VideoCapture(int(source))
+    if not cap.isOpened():
+        logger.warning("Không mở được camera: %s", source)
+        return cap, None
+
+    # Giữ ít frame trong driver để ảnh chụp không bị trễ
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+    mode = negotiate_camera_mode(cap, modes)
+    logger.info("Camera %s: %dx%d @ %s FPS (đo được %.1f), FOURCC %s",
+                source, mode.width, mode.height, mode.fps, mode.measured_fps, mode.fourcc or "?")
+    return cap, mode
+
+# ==========================================
+# LUỒNG CAMERA (CAMERA WORKER)
+# ==========================================
+
+class CameraWorker(QThread):
+    """Đọc camera trên luồng riêng, ghi vào ring buffer và chỉ báo frame mới nhất cho GUI.
+
+    Nếu có still_cap hoặc still_mode, request_still() chụp thêm một ảnh độ
+    phân giải cao (từ luồng thứ hai, hoặc tạm đổi chế độ camera) và trả về qua
+    tín hiệu still_ready(frame, token).
+
+    Nếu cap là None, opener() được gọi trên luồng camera để mở camera (trả về
+    cap, still_cap, mode) rồi phát camera_opened(mode), nên việc dò chế độ
+    camera không chặn giao diện.
+
+    set_active(False) cho luồng ngừng đọc frame (và đóng hẳn camera nếu
+    release=True, mở lại bằng opener khi được bật lại).
+
+    schedule_capture(deadline, token) hẹn chụp: frame đầu tiên có timestamp
+    không sớm hơn deadline được copy ngay trên luồng camera và trả về qua
+    frame_captured(frame, timestamp, token), không phụ thuộc luồng GUI bận hay rảnh.
+    Ở chế độ burst, các frame ngay trước (từ ring) và sau deadline được gom
+    thêm và trả về qua burst_ready(frames, token) để chọn ảnh đẹp nhất.
+    """
+
+    frame_ready = pyqtSignal()
+    still_ready = pyqtSignal(object, object)
+    camera_opened = pyqtSignal(object)
+    frame_captured = pyqtSignal(object, float, object)
+    burst_ready = pyqtSignal(object, object)
+
+    def __init__(self, cap=None, ring_size=CAMERA_RING_SIZE, mirror=True, still_cap=None,
+                 still_mode=CAMERA_STILL_MODE, still_warmup=CAMERA_STILL_WARMUP, opener=None,
+                 burst_frames=BURST_FRAMES, burst_before=BURST_BEFORE, parent=None):
+        super().__init__(parent)
+        self.cap = cap
+        self.opener = opener
+        self.ring_size = ring_size
+        self.mirror = mirror
+        self.still_cap = still_cap
+        self.still_mode = still_mode
+        self.still_warmup = still_warmup
+        self._still_requests = []
+        self._captures = []          # (deadline, thứ tự, token) đã sắp xếp theo deadline
+        self._capture_order = itertools.count()
+        self.burst_frames = burst_frames
+        self.burst_before = min(burst_before, ring_size - 2, burst_frames - 1)
+        self._bursts = []            # [token, danh sách frame, số frame sau deadline còn thiếu]
+        self._active = threading.Event()
+        self._active.set()
+        self._release_when_idle = False
+
+        self._lock = threading.Lock()
+        self._running = False
+        self._raw = None             # Buffer đọc thô, tái sử dụng mỗi frame
+        self._ring = None            # Mảng (ring_size, H, W, 3) cấp phát một lần
+        self._timestamps = [0.0] * ring_size
+        self._latest = -1            # Slot chứa frame mới nhất
+        self._seq = 0                # Tổng số frame đã ghi vào ring
+        self._consumed_seq = 0       # Frame cuối cùng GUI đã lấy
+        self._signal_pending = False # Đã báo GUI nhưng GUI chưa lấy frame
+        self._frame_times = deque(maxlen=30)
+
+        # Thống kê
+        self.fps = 0.0
+        self.frames_dropped = 0
+        self.read_failures = 0
+
+    def run(self):
+        """Vòng lặp đọc camera."""
+        self._running = True
+        if self.cap is None and self.opener is not None:
+            self.cap, self.still_cap, mode = self.opener()
+            self.camera_opened.emit(mode)
+        while self._running:
+            if self._still_requests:
+                with self._lock:
+                    requests, self._still_requests = self._still_requests, []
+                still = self._grab_still()
+                for token in requests:
+                    self.still_ready.emit(still, token)
+
+            if not self._active.is_set():
+                self._idle()
+                continue
+            if self.cap is None and self.opener is not None:
+                # Camera đã được đóng khi rảnh: mở lại
+                self.cap, self.still_cap, mode = self.opener()
+                self.camera_opened.emit(mode)
+
+            # grab() chờ frame kế tiếp (theo FPS camera), chỉ đo phần giải mã/chuyển đổi
+            ret, frame = self.cap.grab(), None
+            if ret:
+                with perf_monitor.timer("camera.read"):
+                    if self._raw is None:
+                        ret, frame = self.cap.retrieve()
+                    else:
+                        ret, frame = self.cap.retrieve(self._raw)
+            if not ret or frame is None:
+                self.read_failures += 1
+                self.msleep(100)
+                continue
+            self._raw = frame
+
+            if self._ring is None or self._ring.shape[1:] != frame.shape:
+                with self._lock:
+                    self._ring = np.empty((self.ring_size,) + frame.shape, dtype=frame.dtype)
+                    self._latest = -1
+
+            slot = (self._latest + 1) % self.ring_size
+            with perf_monitor.timer("camera.flip"):
+                if self.mirror:
+                    cv2.flip(frame, 1, dst=self._ring[slot])
+                else:
+                    np.copyto(self._ring[slot], frame)
+
+            now = time.monotonic()
+            self._frame_times.append(now)
+            if len(self._frame_times) > 1:
+                span = self._frame_times[-1] - self._frame_times[0]
+                if span > 0:
+                    self.fps = (len(self._frame_times) - 1) / span
+
+            with self._lock:
+                self._timestamps[slot] = now
+                self._latest = slot
+                self._seq += 1
+                notify = not self._signal_pending
+                self._signal_pending = True
+            # Chỉ phát tín hiệu khi GUI đã lấy frame trước đó, tránh dồn hàng đợi sự kiện
+            if notify:
+                self.frame_ready.emit()
+
+            if self._bursts:
+                self._extend_bursts(slot)
+            if self._captures and now >= self._captures[0][0]:
+                self._deliver_captures(slot, now)
+
+    def _deliver_captures(self, slot, timestamp):
+        """Trả frame ở slot cho mọi lịch chụp đã tới hạn, ghi độ trễ màn trập."""
+        with self._lock:
+            split = bisect.bisect_right(self._captures, (timestamp, float("inf")))
+            due, self._captures = self._captures[:split], self._captures[split:]
+            if self.has_still():
+                self._still_requests.extend(token for _, _, token in due)
+        for deadline, _, token in due:
+            perf_monitor.record("capture.shutter_latency", (timestamp - deadline) * 1000)
+            frame = self._ring[slot].copy()
+            self.frame_captured.emit(frame, timestamp, token)
+            if self.burst_enabled():
+                frames = self._previous_frames(slot, timestamp) + [frame]
+                self._bursts.append([token, frames, self.burst_frames - len(frames)])
+                self._extend_bursts(None)
+
+    def burst_enabled(self):
+        """Có gom burst quanh deadline hay không (ảnh độ phân giải cao riêng thì không)."""
+        return self.burst_frames > 1 and not self.has_still()
+
+    def _previous_frames(self, slot, timestamp):
+        """Bản copy của tối đa burst_before frame ngay trước slot còn trong ring, cũ nhất trước."""
+        frames = []
+        for back in range(1, min(self.burst_before, self._seq - 1) + 1):
+            prev = (slot - back) % self.ring_size
+            age = timestamp - self._timestamps[prev]
+            if not 0 < age <= BURST_MAX_AGE:
+                break
+            frames.insert(0, self._ring[prev].copy())
+        return frames
+
+    def _extend_bursts(self, slot):
+        """Thêm frame mới vào các burst đang gom; burst đủ frame (hoặc slot None và không thiếu) được phát."""
+        pending = []
+        for burst in self._bursts:
+            token, frames, missing = burst
+            if slot is not None and missing > 0:
+                frames.append(self._ring[slot].copy())
+                missing = burst[2] = missing - 1
+            if missing > 0:
+                pending.append(burst)
+            else:
+                self.burst_ready.emit(frames, token)
+        self._bursts = pending
+
+    def _flush_bursts(self):
+        """Phát các burst còn dở với số frame đã có (khi camera tạm dừng)."""
+        for token, frames, _ in self._bursts:
+            self.burst_ready.emit(frames, token)
+        self._bursts = []
+
+    def schedule_capture(self, deadline, token):
+        """Hẹn chụp frame đầu tiên có timestamp (time.monotonic) từ deadline trở đi."""
+        with self._lock:
+            bisect.insort(self._captures, (deadline, next(self._capture_order), token))
+
+    def cancel_captures(self):
+        """Hủy mọi lịch chụp chưa tới hạn."""
+        with self._lock:
+            self._captures = []
+        # Burst đang gom vẫn được phát, GUI tự bỏ qua theo mã phiên
+
+    def _idle(self):
+        """Chờ được bật lại, không đọc camera; đóng camera nếu được yêu cầu."""
+        if self._bursts:
+            self._flush_bursts()
+        with self._lock:
+            self._latest = -1
+        self._frame_times.clear()
+        if self._release_when_idle and self.opener is not None and self.cap is not None:
+            self.release()
+            self.cap = self.still_cap = None
+            self._raw = None
+        self._active.wait(0.2)
+
+    def set_active(self, active, release=False):
+        """Bật/tắt việc đọc camera; release=True đóng camera trong lúc tắt."""
+        self._release_when_idle = release
+        if active:
+            self._active.set()
+        else:
+            self._active.clear()
+
+    def is_active(self):
+        return self._active.is_set()
+
+    def stop(self):
+        """Dừng luồng và chờ kết thúc."""
+        self._running = False
+        self._active.set()
+        self.wait()
+
+    def release(self):
+        """Đóng camera (gọi sau stop())."""
+        if self.cap is not None:
+            self.cap.release()
+        if self.still_cap is not None:
+            self.still_cap.release()
+
+    def has_still(self):
+        """Có chụp ảnh độ phân giải cao riêng hay không."""
+        return self.still_cap is not None or self.still_mode is not None
+
+    def still_shape(self):
+        """Kích thước (cao, rộng, 3) dự kiến của ảnh chụp độ phân giải cao, hoặc None."""
+        if self.still_cap is not None:
+            width = int(self.still_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self.still_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            return (height, width, 3) if width and height else None
+        if self.still_mode is not None:
+            return (self.still_mode[1], self.still_mode[0], 3)
+        return None
+
+    def request_still(self, token):
+        """Yêu cầu chụp ảnh độ phân giải cao ở lượt đọc tiếp theo; trả về False nếu không hỗ trợ."""
+        if not self.has_still():
+            return False
+        with self._lock:
+            self._still_requests.append(token)
+        return True
+
+    def _grab_still(self):
+        """Chụp một ảnh độ phân giải cao (đã lật như xem trước), hoặc None nếu lỗi."""
+        if self.still_cap is not None:
+            # Bỏ frame cũ còn trong buffer của driver
+            self.still_cap.grab()
+            ret, frame = self.still_cap.read()
+        else:
+            preview_w = self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+            preview_h = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.still_mode[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.still_mode[1])
+            for _ in range(self.still_warmup):
+                self.cap.grab()
+            ret, frame = self.cap.read()
+            # Trở về chế độ xem trước
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, preview_w)
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, preview_h)
+            self._raw = None
+        if not ret or frame is None:
+            return None
+        return cv2.flip(frame, 1) if self.mirror else frame
+
+    def latest_frame(self):
+        """Lấy frame mới nhất (frame, timestamp) hoặc (None, 0).
+
+        Frame là view vào ring buffer, chỉ hợp lệ tới khi luồng camera ghi
+        thêm ring_size - 1 frame nữa; cần copy nếu muốn giữ lâu hơn.
+        """
+        with self._lock:
+            self._signal_pending = False
+            if self._latest < 0:
+                return None, 0.0
+            if self._consumed_seq and self._seq - self._consumed_seq > 1:
+                self.frames_dropped += self._seq - self._consumed_seq - 1
+            self._consumed_seq = self._seq
+            return self._ring[self._latest], self._timestamps[self._latest]
+
+    def stats(self):
+        """Thống kê luồng camera: FPS đo được, số frame GUI bỏ qua, số lần đọc lỗi."""
+        return {
+            "fps": round(self.fps, 1),
+            "frames": self._seq,
+            "dropped": self.frames_dropped,
+            "read_failures": self.read_failures,
+        }
+
+# ==========================================
+# LỊCH CHỤP (CAPTURE SCHEDULER)
+# ==========================================
+
+class CaptureScheduler(QObject):
+    """Lịch chụp theo đồng hồ monotonic: ảnh k tới hạn lúc t0 + first_delay + k * between_delay.
+
+    Số giây đếm ngược được tính lại từ thời gian còn lại mỗi tick ngắn nên
+    không bị trôi khi timer trễ; phát countdown(số giây) khi số hiển thị đổi
+    và shot_due(k, deadline) khi tới hạn.
+    """
+
+    countdown = pyqtSignal(int)
+    shot_due = pyqtSignal(int, float)
+
+    def __init__(self, shots=PHOTOS_TO_TAKE, first_delay=FIRST_PHOTO_DELAY, between_delay=BETWEEN_PHOTO_DELAY,
+                 interval=COUNTDOWN_TICK_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.shots = shots
+        self.first_delay = first_delay
+        self.between_delay = between_delay
+        self.t0 = None
+        self.next_shot = 0
+        self._shown = None
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._tick)
+
+    def deadline(self, index):
+        """Thời điểm (time.monotonic) chụp ảnh thứ index."""
+        return self.t0 + self.first_delay + index * self.between_delay
+
+    def start(self):
+        """Bắt đầu lịch từ bây giờ; trả về danh sách deadline của mọi ảnh."""
+        self.t0 = time.monotonic()
+        self.next_shot = 0
+        self._shown = None
+        self._timer.start()
+        self._tick()
+        return [self.deadline(k) for k in range(self.shots)]
+
+    def stop(self):
+        self._timer.stop()
+
+    def is_active(self):
+        return self._timer.isActive()
+
+    def _tick(self):
+        now = time.monotonic()
+        while self.next_shot < self.shots and now >= self.deadline(self.next_shot):
+            index = self.next_shot
+            self.next_shot += 1
+            self._shown = None
+            # Độ trễ của luồng GUI so với deadline (frame vẫn được chọn đúng trên luồng camera)
+            perf_monitor.record("countdown.lag", (now - self.deadline(index)) * 1000)
+            self.shot_due.emit(index, self.deadline(index))
+        if self.next_shot >= self.shots:
+            self._timer.stop()
+            return
+        remaining = math.ceil(self.deadline(self.next_shot) - now)
+        if remaining != self._shown:
+            self._shown = remaining
+            self.countdown.emit(remaining)
+
+# ==========================================
+# XỬ LÝ NỀN (BACKGROUND TASKS)
+# ==========================================
+
+class TaskRunner(QObject):
+    """Chạy hàm trên thread pool và gọi callback với kết quả trên luồng GUI.
+
+    Lỗi trong việc nền luôn được ghi log kèm traceback; error_callback(lỗi) cho
+    phép nơi gọi dọn trạng thái đang chờ (cũng được gọi trên luồng GUI).
+    """
+
+    _finished = pyqtSignal(object, object)  # (callback, kết quả)
+
+    def __init__(self, max_workers=BACKGROUND_WORKERS, parent=None):
+        super().__init__(parent)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="photobooth")
+        self._finished.connect(self._deliver)
+
+    def submit(self, fn, *args, callback=None, error_callback=None):
+        """Chạy fn(*args) ở luồng nền; callback(kết quả) hoặc error_callback(lỗi) được gọi trên luồng GUI."""
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self._on_done(f, fn, callback, error_callback))
+        return future
+
+    def _on_done(self, future, fn, callback, error_callback):
+        # Chạy trên luồng nền: chuyển kết quả về luồng GUI qua tín hiệu
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error("Lỗi việc nền %s", getattr(fn, "__name__", fn),
+                         exc_info=(type(error), error, error.__traceback__))
+            if error_callback is not None:
+                self._finished.emit(error_callback, error)
+            return
+        if callback is not None:
+            self._finished.emit(callback, future.result())
+
+    def _deliver(self, callback, result):
+        callback(result)
+
+    def shutdown(self):
+        """Hủy các việc chưa chạy và chờ việc đang chạy xong."""
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+def make_photo_thumbnail(image, size=PHOTO_THUMB_SIZE):
+    """Tạo thumbnail QImage cho lưới chọn ảnh (an toàn khi gọi ở luồng nền)."""
+    thumb = cv2.resize(image, size, interpolation=resize_interpolation(image.shape[1], size[0]))
+    if not HAS_BGR888:
+        thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2RGB)
+    h, w = thumb.shape[:2]
+    qt_format = QImage.Format_BGR888 if HAS_BGR888 else QImage.Format_RGB888
+    # copy() để QImage tự giữ dữ liệu sau khi mảng numpy bị giải phóng
+    return QImage(thumb.data, w, h, thumb.strides[0], qt_format).copy()
+
+def score_burst_frames(frames, width=BURST_SCORE_WIDTH):
+    """Điểm của từng frame trong burst: độ nét nhân hệ số phơi sáng (mảng numpy, cao hơn là tốt hơn).
+
+    Độ nét là phương sai Laplacian trên bản xám thu nhỏ (ảnh rung/nhòe có ít
+    cạnh nên phương sai thấp); hệ số phơi sáng giảm theo độ lệch độ sáng trung
+    bình khỏi mức giữa và theo tỉ lệ điểm ảnh bị cháy hoặc quá tối. Chỉ so các
+    frame cùng kích thước với frame cuối (chế độ camera hiện tại); frame khác
+    kích thước (camera vừa đổi chế độ giữa burst) nhận điểm -inf.
+    """
+    h, w = frames[-1].shape[:2]
+    size = (width, max(1, round(h * width / w))) if w > width else (w, h)
+    scores = np.full(len(frames), -np.inf)
+    for i, frame in enumerate(frames):
+        if frame.shape != frames[-1].shape:
+            continue
+        gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), size, interpolation=cv2.INTER_AREA)
+        sharpness = cv2.Laplacian(gray, cv2.CV_32F).var()
+        clipped = np.count_nonzero((gray <= 8) | (gray >= 247)) / gray.size
+        exposure = max(0.0, 1 - abs(gray.mean() - 128) / 128) * (1 - clipped)
+        scores[i] = sharpness * exposure
+    return scores
+
+def pick_best_frame(frames):
+    """Chọn frame có điểm cao nhất trong burst: trả về (frame, vị trí trong burst)."""
+    with perf_monitor.timer("capture.burst_score"):
+        best = int(np.argmax(score_burst_frames(frames)))
+    return frames[best], best
+
+# ==========================================
+# LƯU ẢNH CHỤP TRONG PHIÊN (CAPTURE STORE)
+# ==========================================
+
+class CaptureStore:
+    """Ảnh chụp của một phiên, truy cập như list (len, [i], for).
+
+    Chế độ "array" copy mỗi ảnh vào một slot của mảng (N, H, W, 3) cấp phát
+    một lần và dùng lại qua các phiên; chế độ "jpeg" giữ bản nén trong RAM và
+    chỉ giải mã khi đọc. frame_shape cố định kích thước slot (ví dụ kích thước
+    ảnh chụp độ phân giải cao) thay vì lấy theo ảnh đầu tiên.
+
+    Ở chế độ "jpeg", submit (ví dụ TaskRunner.submit) cho phép nén ở luồng nền:
+    ảnh gốc được giữ làm bản tạm cho tới khi nén xong. Không có submit thì
+    put() nén ngay trên luồng gọi (chặn luồng GUI vài chục ms mỗi ảnh).
+    """
+
+    def __init__(self, capacity=PHOTOS_TO_TAKE, mode=CAPTURE_STORAGE, jpeg_quality=CAPTURE_JPEG_QUALITY,
+                 frame_shape=None, submit=None):
+        if mode not in ("array", "jpeg"):
+            raise ValueError(f"Chế độ lưu ảnh không hợp lệ: {mode}")
+        self.capacity = capacity
+        self.mode = mode
+        self.jpeg_quality = jpeg_quality
+        self.frame_shape = frame_shape
+        self.submit = submit
+        self._array = None
+        self._encoded = [None] * capacity
+        self._raw = [None] * capacity      # Ảnh gốc chờ nén (chế độ "jpeg")
+        self._versions = [0] * capacity    # Tăng mỗi lần slot đổi, để bỏ kết quả nén đã cũ
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        if self.mode == "jpeg":
+            raw = self._raw[index]
+            if raw is not None:
+                return raw
+            return cv2.imdecode(self._encoded[index], cv2.IMREAD_COLOR)
+        return self._array[index]
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def reader(self, index):
+        """Hàm không tham số trả về ảnh index như lúc gọi, an toàn để chạy ở luồng nền.
+
+        Chế độ "array" copy ngay (slot có thể bị put() ghi đè trong lúc luồng nền
+        đọc); chế độ "jpeg" giữ bản nén hiện tại và chỉ giải mã khi hàm được gọi.
+        """
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        if self.mode == "jpeg":
+            raw, encoded = self._raw[index], self._encoded[index]
+            if raw is not None:
+                # Ảnh gốc chưa nén không bao giờ bị sửa, put() chỉ thay bằng mảng khác
+                return lambda: raw
+            return lambda: cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        frame = self[index].copy()
+        return lambda: frame
+
+    def clear(self):
+        """Xóa ảnh của phiên cũ; mảng đã cấp phát được giữ lại cho phiên sau."""
+        self._count = 0
+        self._encoded = [None] * self.capacity
+        self._raw = [None] * self.capacity
+        self._versions = [version + 1 for version in self._versions]
+
+    def _encode(self, frame):
+        ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            raise ValueError("Không nén được ảnh chụp")
+        return encoded
+
+    def _store_encoded(self, index, version, encoded):
+        """Nhận bản nén từ luồng nền; bỏ qua nếu slot đã đổi từ lúc gửi đi."""
+        if self._versions[index] == version:
+            self._encoded[index] = encoded
+            self._raw[index] = None
+
+    def add(self, frame):
+        """Lưu frame vào slot tiếp theo, trả về chỉ số của ảnh."""
+        index = self._count
+        self.put(index, frame)
+        return index
+
+    def put(self, index, frame):
+        """Lưu frame vào slot index (copy, frame gốc có thể bị ghi đè sau đó)."""
+        if not 0 <= index < self.capacity:
+            raise IndexError(index)
+        if self.mode == "jpeg":
+            self._versions[index] += 1
+            version = self._versions[index]
+            if self.submit is None:
+                self._raw[index] = None
+                self._encoded[index] = self._encode(frame)
+            else:
+                raw = self._raw[index] = frame.copy()
+                self._encoded[index] = None
+                self.submit(self._encode, raw, callback=functools.partial(self._store_encoded, index, version))
+        else:
+            shape = tuple(self.frame_shape or frame.shape)
+            if self._array is None or (self._count == 0 and self._array.shape[1:] != shape):
+                self._array = np.empty((self.capacity,) + shape, dtype=np.uint8)
+            slot = self._array[index]
+            if slot.shape == frame.shape:
+                np.copyto(slot, frame)
+            else:
+                # Camera đổi độ phân giải giữa phiên: đưa về kích thước của các ảnh trước
+                cv2.resize(frame, (slot.shape[1], slot.shape[0]), dst=slot)
+        self._count = max(self._count, index + 1)
+
+# ==========================================
+# DỊCH VỤ MÁY IN (PRINTER SERVICE)
+# ==========================================
+
+class WindowsPrinterBackend:
+    """Máy in Windows: dò bằng PowerShell Get-Printer, in bằng os.startfile."""
+
+    name = "windows"
+
+    def discover(self):
+        return check_printer_available()
+
+    def print_file(self, path):
+        os.startfile(path, "print")
+
+class SpoolDirPrinterBackend:
+    """Máy in giả: copy file in vào một thư mục spool (thử nghiệm, booth không chạy Windows)."""
+
+    name = "spool"
+
+    def __init__(self, spool_dir=PRINTER_SPOOL_DIR):
+        self.spool_dir = spool_dir
+
+    def discover(self):
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+        except OSError as e:
+            return False, str(e)
+        if not os.access(self.spool_dir, os.W_OK):
+            return False, f"Không ghi được vào {self.spool_dir}"
+        return True, f"Spool ({os.path.abspath(self.spool_dir)})"
+
+    def print_file(self, path):
+        shutil.copy2(path, os.path.join(self.spool_dir, os.path.basename(path)))
+
+def create_printer_backend(name=PRINTER_BACKEND):
+    """Tạo backend máy in theo tên cấu hình."""
+    if name == "auto":
+        name = "windows" if os.name == 'nt' else "spool"
+    if name == "windows":
+        return WindowsPrinterBackend()
+    if name == "spool":
+        return SpoolDirPrinterBackend()
+    raise ValueError(f"Backend máy in không hợp lệ: {name}")
+
+class PrinterService(QThread):
+    """Giữ trạng thái máy in đã dò; luồng nền dò lại định kỳ nên status() trả lời ngay lập tức."""
+
+    status_changed = pyqtSignal(bool, str)
+
+    def __init__(self, backend, poll_interval=PRINTER_POLL_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self._status = None  # (ok, info) hoặc None khi chưa dò lần nào
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = False
+
+    def run(self):
+        """Dò máy in ngay khi khởi động, sau đó lặp lại mỗi poll_interval giây."""
+        self._running = True
+        while self._running:
+            self.poll()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def poll(self):
+        """Dò máy in đồng bộ (chỉ gọi từ luồng nền) và cập nhật cache."""
+        try:
+            status = self.backend.discover()
+        except Exception as e:
+            status = (False, str(e))
+        with self._lock:
+            changed = status != self._status
+            self._status = status
+        if changed:
+            self.status_changed.emit(*status)
+        return status
+
+    def status(self):
+        """Trạng thái đã cache (ok, info); không chạy lệnh dò máy in."""
+        with self._lock:
+            if self._status is None:
+                return False, "Đang dò máy in..."
+            return self._status
+
+    def refresh(self):
+        """Yêu cầu luồng nền dò lại ngay."""
+        self._wake.set()
+
+    def print_file(self, path):
+        self.backend.print_file(path)
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+        self.wait()
+
+# ==========================================
+# MÃ HÓA ẢNH ĐẦU RA (OUTPUT ENCODER)
+# ==========================================
+
+# Chỉ có từ OpenCV 4.5.5; bản cũ hơn dùng lấy mẫu mặc định của libjpeg (4:2:0)
+JPEG_SAMPLING_FACTORS = {
+    name: getattr(cv2, f"IMWRITE_JPEG_SAMPLING_FACTOR_{name}")
+    for name in ("444", "422", "420")
+    if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR") and hasattr(cv2, f"IMWRITE_JPEG_SAMPLING_FACTOR_{name}")
+}
+
+# Một bản đầu ra: tên, thư mục (None = cùng thư mục file in), đuôi file, tham số imencode, chiều rộng (None = giữ nguyên)
+OutputSpec = namedtuple("OutputSpec", "name directory ext params width")
+# Kết quả mã hóa một bản: đường dẫn, kích thước file (byte), thời gian (ms)
+OutputResult = namedtuple("OutputResult", "name path size ms")
+
+def jpeg_params(quality=OUTPUT_JPEG_QUALITY, sampling=OUTPUT_JPEG_SAMPLING, optimize=OUTPUT_JPEG_OPTIMIZE):
+    """Tham số cv2.imencode cho JPEG."""
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize)]
+    factor = JPEG_SAMPLING_FACTORS.get(sampling)
+    if factor is not None:
+        params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, factor]
+    return params
+
+def default_output_specs():
+    """Các bản đầu ra phụ theo cấu hình (bản lưu trữ không mất dữ liệu, bản chia sẻ web)."""
+    specs = []
+    if OUTPUT_ARCHIVE_FORMAT == "png":
+        # Mức nén thấp: nhanh hơn nhiều, file chỉ lớn hơn chút ít
+        specs.append(OutputSpec("archive", OUTPUT_ARCHIVE_DIR, ".png", [cv2.IMWRITE_PNG_COMPRESSION, 1], None))
+    elif OUTPUT_ARCHIVE_FORMAT == "webp":
+        # Chất lượng > 100 là WebP lossless
+        specs.append(OutputSpec("archive", OUTPUT_ARCHIVE_DIR, ".webp", [cv2.IMWRITE_WEBP_QUALITY, 101], None))
+    elif OUTPUT_ARCHIVE_FORMAT is not None:
+        raise ValueError(f"OUTPUT_ARCHIVE_FORMAT không hợp lệ: {OUTPUT_ARCHIVE_FORMAT!r}")
+    if OUTPUT_WEB_WIDTH:
+        specs.append(OutputSpec("web", OUTPUT_WEB_DIR, ".jpg",
+                                jpeg_params(OUTPUT_WEB_QUALITY, "420", True), OUTPUT_WEB_WIDTH))
+    return specs
+
+def encode_output(name, image, path, params, width=None, session=None):
+    """Mã hóa image (thu nhỏ về width nếu cần) và ghi ra path; trả về OutputResult."""
+    start = time.perf_counter()
+    h, w = image.shape[:2]
+    if width and w > width:
+        image = cv2.resize(image, (width, max(1, round(h * width / w))), interpolation=cv2.INTER_AREA)
+    ok, data = cv2.imencode(os.path.splitext(path)[1], image, params)
+    if not ok:
+        raise OSError(f"Không mã hóa được {path}")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    ms = (time.perf_counter() - start) * 1000
+    perf_monitor.record(f"encode.{name}", ms, session)
+    return OutputResult(name, path, data.size, ms)
+
+class OutputEncoder:
+    """Ghi file in trên luồng gọi, các bản phụ được mã hóa song song trên pool luồng riêng.
+
+    cv2.imencode nhả GIL khi nén nên pool luồng tận dụng được nhiều nhân mà
+    không phải copy ảnh sang tiến trình khác. Bản phụ chỉ được đưa vào pool sau
+    khi file in đã ghi xong để không tranh CPU với file cần tới máy in trước.
+    """
+
+    def __init__(self, print_params=None, extras=None, workers=OUTPUT_ENCODER_WORKERS):
+        self.print_params = jpeg_params() if print_params is None else print_params
+        self.extras = default_output_specs() if extras is None else extras
+        self._pool = None
+        if self.extras:
+            self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encoder")
+
+    def encode_print(self, image, filepath, session=None):
+        """Ghi file in (JPEG theo cấu hình) ngay trên luồng gọi."""
+        result = encode_output("print", image, filepath, self.print_params, session=session)
+        self._report(result)
+        return result
+
+    def submit_extras(self, image, filepath, callback=None, session=None):
+        """Đưa các bản phụ của filepath vào pool; callback(OutputResult) được gọi trên luồng pool khi xong."""
+        futures = []
+        if self._pool is None:
+            return futures
+        base = os.path.splitext(os.path.basename(filepath))[0]
+        for spec in self.extras:
+            directory = spec.directory if spec.directory is not None else os.path.dirname(filepath)
+            path = os.path.join(directory, base + spec.ext)
+            future = self._pool.submit(encode_output, spec.name, image, path, spec.params, spec.width, session)
+            future.add_done_callback(functools.partial(self._on_done, callback))
+            futures.append(future)
+        return futures
+
+    def _on_done(self, callback, future):
+        error = future.exception()
+        if error is not None:
+            logger.warning("Lỗi mã hóa bản phụ: %s", error)
+            return
+        result = future.result()
+        self._report(result)
+        if callback is not None:
+            callback(result)
+
+    @staticmethod
+    def _report(result):
+        logger.info("Đã ghi %s (%s): %.0f KB trong %.1f ms", os.path.basename(result.path), result.name,
+                    result.size / 1024, result.ms)
+
+    def shutdown(self):
+        """Chờ các bản phụ đang mã hóa ghi xong."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+# ==========================================
+# HÀNG ĐỢI LƯU VÀ IN ẢNH (PRINT QUEUE)
+# ==========================================
+
+# Trạng thái của job in tại một thời điểm, gửi sang GUI thay cho job đang bị luồng in sửa
+PrintJobStatus = namedtuple("PrintJobStatus", "id filepath session state attempts printer error image")
+
+class PrintJob:
+    """Một lệnh lưu và in ảnh."""
+
+    QUEUED = "QUEUED"
+    RENDERING = "RENDERING"
+    ENCODING = "ENCODING"
+    SPOOLING = "SPOOLING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+
+    _ids = itertools.count(1)
+
+    def __init__(self, filepath, image=None, render=None, session=None):
+        """Truyền sẵn image, hoặc render là hàm không tham số trả về ảnh (chạy trên luồng in).
+
+        session là mã phiên chụp, để thời gian dựng/lưu/gửi máy in được ghi vào đúng phiên.
+        """
+        self.id = next(PrintJob._ids)
+        self.session = session
+        self.image = image
+        self.render = render
+        self.filepath = filepath
+        self.state = PrintJob.QUEUED
+        self.attempts = 0
+        self.printer = None
+        self.error = None
+        self._outputs = {}  # tên bản đầu ra -> OutputResult, ghi từ luồng in và pool mã hóa
+        self._outputs_lock = threading.Lock()
+
+    def add_output(self, result):
+        """Ghi nhận một bản đầu ra đã mã hóa xong (gọi được từ mọi luồng)."""
+        with self._outputs_lock:
+            self._outputs[result.name] = result
+
+    def outputs(self):
+        """Các bản đầu ra đã xong: {tên: OutputResult}."""
+        with self._outputs_lock:
+            return dict(self._outputs)
+
+    def snapshot(self):
+        """Bản chụp trạng thái hiện tại (bất biến, an toàn để gửi sang luồng khác)."""
+        return PrintJobStatus(self.id, self.filepath, self.session, self.state, self.attempts,
+                              self.printer, self.error, self.image)
+
+class PrintQueue(QThread):
+    """Lưu và in ảnh tuần tự trên luồng nền, báo trạng thái từng job về GUI qua job_updated."""
+
+    job_updated = pyqtSignal(object)  # PrintJobStatus tại thời điểm phát
+
+    def __init__(self, printer_service, max_retries=PRINT_MAX_RETRIES, retry_delay=PRINT_RETRY_DELAY,
+                 encoder=None, parent=None):
+        super().__init__(parent)
+        self.printer_service = printer_service
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.encoder = encoder if encoder is not None else OutputEncoder()
+        self._queue = queue.Queue()
+
+    def submit(self, job):
+        """Đưa job vào hàng đợi, trả về ngay."""
+        self._set_state(job, PrintJob.QUEUED)
+        self._queue.put(job)
+        return job
+
+    def stop(self):
+        """Dừng sau khi xử lý xong các job đang chờ."""
+        self._queue.put(None)
+        self.wait()
+        self.encoder.shutdown()
+
+    def run(self):
+        """Vòng lặp xử lý job."""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            self.process(job)
+
+    def _set_state(self, job, state, error=None):
+        job.state = state
+        job.error = error
+        self.job_updated.emit(job.snapshot())
+
+    def process(self, job):
+        """Render (nếu cần), lưu file rồi gửi máy in, thử lại tối đa max_retries lần nếu gửi lỗi."""
+        try:
+            if job.image is None:
+                self._set_state(job, PrintJob.RENDERING)
+                with perf_monitor.timer("print.render", job.session):
+                    job.image = job.render()
+                job.render = None
+            self._set_state(job, PrintJob.ENCODING)
+            with perf_monitor.timer("print.save", job.session):
+                job.add_output(self.encoder.encode_print(job.image, job.filepath, job.session))
+            # Bản lưu trữ / chia sẻ web được mã hóa trong lúc gửi máy in
+            self.encoder.submit_extras(job.image, job.filepath, job.add_output, job.session)
+        except Exception as e:
+            self._set_state(job, PrintJob.FAILED, str(e))
+            return
+
+        error = None
+        for attempt in range(1, self.max_retries + 2):
+            job.attempts = attempt
+            self._set_state(job, PrintJob.SPOOLING)
+            try:
+                printer_ok, printer_info = self.printer_service.status()
+                if not printer_ok:
+                    # Cache có thể đã cũ, dò lại ngay trên luồng này
+                    printer_ok, printer_info = self.printer_service.poll()
+                if not printer_ok:
+                    raise RuntimeError(printer_info)
+                job.printer = printer_info
+                with perf_monitor.timer("print.spool", job.session):
+                    self.printer_service.print_file(job.filepath)
+                self._set_state(job, PrintJob.DONE)
+                return
+            except Exception as e:
+                error = str(e)
+                if attempt <= self.max_retries:
+                    self.msleep(self.retry_delay)
+        self._set_state(job, PrintJob.FAILED, error)
+
+# ==========================================
+# CACHE THUMBNAIL
+# ==========================================
+
+class ThumbnailCache:
+    """Cache thumbnail LRU có giới hạn, lưu thêm xuống đĩa để lần sau không giải mã lại ảnh gốc."""
+
+    def __init__(self, size, capacity=THUMBNAIL_CACHE_SIZE, cache_dir=THUMBNAIL_CACHE_DIR):
+        self.size = size  # (rộng, cao) tối đa của thumbnail
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self._pixmaps = OrderedDict()  # path -> QPixmap, theo thứ tự dùng gần nhất
+        self._pending = {}  # path -> các callback chờ thumbnail đang đọc ở luồng nền
+
+    def _disk_path(self, path):
+        """Đường dẫn file thumbnail trên đĩa, gắn với mtime và kích thước thumbnail."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        digest = hashlib.md5(os.path.abspath(path).encode("utf-8")).hexdigest()
+        name = f"{digest}_{mtime}_{self.size[0]}x{self.size[1]}.jpg"
+        return os.path.join(self.cache_dir, name)
+
+    def _decode(self, path):
+        """Giải mã ảnh gốc ở độ phân giải thấp nhất còn đủ cho thumbnail."""
+        tw, th = self.size
+        img = None
+        # JPEG có thể giải mã thu nhỏ ngay trong bước IDCT, nhanh hơn nhiều so với giải mã đầy đủ
+        for flag in (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_COLOR):
+            img = cv2.imread(path, flag)
+            if img is None:
+                return None
+            h, w = img.shape[:2]
+            if w >= tw or h >= th:
+                break
+        return self._fit(img)
+
+    def _fit(self, img):
+        """Thu nhỏ ảnh cho vừa kích thước thumbnail, giữ tỉ lệ."""
+        tw, th = self.size
+        h, w = img.shape[:2]
+        scale = min(tw / w, th / h)
+        if scale < 1:
+            img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))),
+                             interpolation=cv2.INTER_AREA)
+        return img
+
+    def _store(self, path, pixmap):
+        """Thêm pixmap vào LRU, loại bỏ mục cũ nhất khi vượt giới hạn."""
+        self._pixmaps[path] = pixmap
+        self._pixmaps.move_to_end(path)
+        if len(self._pixmaps) > self.capacity:
+            self._pixmaps.popitem(last=False)
+        return pixmap
+
+    def _save(self, disk_path, thumb):
+        """Ghi thumbnail xuống đĩa, bỏ qua lỗi vì cache đĩa chỉ là tùy chọn."""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            cv2.imwrite(disk_path, thumb)
+        except (OSError, cv2.error):
+            pass
+
+    def put(self, path, image):
+        """Tạo thumbnail từ ảnh đang có trong bộ nhớ (ví dụ ảnh vừa in), không cần đọc lại file."""
+        thumb = self._fit(image)
+        disk_path = self._disk_path(path)
+        if disk_path:
+            self._save(disk_path, thumb)
+        return self._store(path, convert_cv_qt(thumb))
+
+    def load(self, path):
+        """Đọc thumbnail (mảng BGR) từ đĩa hoặc giải mã ảnh gốc; gọi được từ luồng nền."""
+        disk_path = self._disk_path(path)
+        thumb = cv2.imread(disk_path) if disk_path and os.path.exists(disk_path) else None
+        if thumb is None:
+            thumb = self._decode(path)
+            if thumb is not None and disk_path:
+                self._save(disk_path, thumb)
+        return thumb
+
+    def prune(self, paths):
+        """Xóa file thumbnail trên đĩa không ứng với ảnh nào trong paths (ảnh đã xóa hoặc đã sửa).
+
+        Tên file gắn với mtime nên mỗi lần ảnh gốc đổi lại để lại một file cũ;
+        gọi lúc khởi động (luồng nền) để thư mục không phình ra theo thời gian.
+        Trả về số file đã xóa.
+        """
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return 0
+        keep = {os.path.basename(disk_path) for disk_path in map(self._disk_path, paths) if disk_path}
+        removed = 0
+        for name in names:
+            if name in keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def store(self, path, thumb):
+        """Đưa thumbnail đã đọc ở luồng nền vào cache (chỉ gọi trên luồng GUI)."""
+        return self._store(path, convert_cv_qt(thumb))
+
+    def peek(self, path):
+        """Thumbnail đã có trong RAM (chỉ gọi trên luồng GUI), None nếu chưa đọc; không chạm đĩa."""
+        pixmap = self._pixmaps.get(path)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(path)
+        return pixmap
+
+    def request(self, path, submit, callback):
+        """Đọc thumbnail ở luồng nền qua submit (TaskRunner.submit), mỗi ảnh một lần dù nhiều nơi chờ.
+
+        callback(path) được gọi trên luồng GUI khi thumbnail đã vào cache. Ảnh
+        không đọc được vẫn nhận một pixmap rỗng để không bị đọc lại liên tục.
+        """
+        waiters = self._pending.get(path)
+        if waiters is not None:
+            if callback not in waiters:
+                waiters.append(callback)
+            return
+        self._pending[path] = [callback]
+
+        def on_loaded(thumb):
+            if thumb is not None:
+                self.store(path, thumb)
+            else:
+                self._store(path, QPixmap())
+            for waiter in self._pending.pop(path, ()):
+                waiter(path)
+
+        submit(self.load, path, callback=on_loaded, error_callback=lambda error: on_loaded(None))
+
+    def get(self, path):
+        """Lấy thumbnail QPixmap của ảnh (chỉ gọi trên luồng GUI), None nếu không đọc được."""
+        pixmap = self._pixmaps.get(path)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(path)
+            return pixmap
+
+        thumb = self.load(path)
+        if thumb is None:
+            return None
+        return self.store(path, thumb)
+
+# ==========================================
+# ĐỒNG HỒ ANIMATION (ANIMATION CLOCK)
+# ==========================================
+
+class AnimationClock(QObject):
+    """Một QTimer dùng chung cho mọi animation, phát tick(dt) với dt là số giây thực đã trôi qua.
+
+    Widget di chuyển theo dt nên vẫn đúng tốc độ khi tick bị trễ hoặc khi đổi
+    chu kỳ timer.
+    """
+
+    tick = pyqtSignal(float)
+    MAX_STEP = 0.25  # Giới hạn dt sau khi event loop bị nghẽn lâu, tránh nhảy cóc
+
+    def __init__(self, interval=ANIMATION_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.interval = interval
+        self._last = None
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._on_timeout)
+
+    def start(self):
+        """Chạy đồng hồ (không làm gì nếu đang chạy)."""
+        if not self._timer.isActive():
+            self._last = time.monotonic()
+            self._timer.start(self.interval)
+
+    def stop(self):
+        """Dừng đồng hồ; lần start sau tính dt lại từ đầu."""
+        self._timer.stop()
+        self._last = None
+
+    def is_active(self):
+        return self._timer.isActive()
+
+    def set_interval(self, interval):
+        """Đổi chu kỳ tick (ms); tốc độ animation không đổi vì tính theo thời gian thực."""
+        self.interval = interval
+        if self._timer.isActive():
+            self._timer.setInterval(interval)
+
+    def _on_timeout(self):
+        now = time.monotonic()
+        dt = min(now - self._last, self.MAX_STEP)
+        self._last = now
+        with perf_monitor.timer("carousel.tick"):
+            self.tick.emit(dt)
+
 # ==========================================
 # CAROUSEL PHOTO WIDGET
 # ==========================================
 
 class CarouselPhotoWidget(QWidget):
-    """Widget hiển thị ảnh carousel trôi từ trái sang phải."""
+    """Widget hiển thị ảnh carousel trôi từ trái sang phải.
+
+    Chỉ vẽ các ô đang nhìn thấy trong paintEvent; mỗi ô (nền, viền, thumbnail)
+    được vẽ sẵn thành một QPixmap và giữ trong cache LRU, nên mỗi frame chỉ
+    còn vài lệnh drawPixmap và CPU không tăng theo số ảnh trong gallery.
+    Vị trí cuộn do AnimationClock dùng chung điều khiển theo thời gian thực.
+    Có submit (TaskRunner.submit) thì thumbnail chưa có được đọc ở luồng nền,
+    trong lúc đó ô hiện khung trống; không có thì đọc ngay khi vẽ.
+    """
     
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, thumbnail_cache=None, clock=None, tile_capacity=CAROUSEL_TILE_CACHE_SIZE,
+                 submit=None):
         super().__init__(parent)
         self.photos = []
-        self.photo_labels = []
-        self.current_offset = 0
+        self.current_offset = 0.0
         self.photo_width = 220
         self.photo_height = 280
         self.spacing = 20
-        self.scroll_speed = 2  # pixels per frame
+        self.scroll_speed = CAROUSEL_SCROLL_SPEED  # px/giây, âm = ngược chiều
+        if thumbnail_cache is None:
+            thumbnail_cache = ThumbnailCache(CAROUSEL_THUMB_SIZE)
+        self.thumbnail_cache = thumbnail_cache
+        self._tiles = OrderedDict()  # path -> QPixmap của cả ô, theo thứ tự dùng gần nhất
+        self.tile_capacity = tile_capacity
+        self.submit = submit
+        self._placeholder = None  # Ô trống dùng chung cho ảnh chưa đọc xong thumbnail
         
         self.setMinimumHeight(self.photo_height + 40)
         
-        # Timer cho animation
-        self.scroll_timer = QTimer()
-        self.scroll_timer.timeout.connect(self.update_scroll)
-        self.scroll_timer.start(30)  # ~33 FPS
+        # Animation theo đồng hồ dùng chung
+        if clock is not None:
+            clock.tick.connect(self.update_scroll)
         
     def set_photos(self, photo_paths):
         """Đặt danh sách ảnh cho carousel."""
-        self.photos = photo_paths
-        self.setup_photo_labels()
-        
-    def setup_photo_labels(self):
-        """Tạo các label ảnh cho carousel."""
-        # Xóa các label cũ
-        for label in self.photo_labels:
-            label.deleteLater()
-        self.photo_labels = []
+        self.photos = list(photo_paths)
+        self.current_offset = 0
+        self.update()
+
+    def add_photo(self, photo_path):
+        """Nối thêm một ảnh vào cuối carousel, không dựng lại các ô đã có."""
+        self.photos.append(photo_path)
+        self.update()
+    
+    def update_scroll(self, dt):
+        """Cập nhật vị trí scroll sau dt giây."""
+        if not self.photos or not self.isVisible():
+            return
         
+        # Quay vòng offset khi đã cuộn qua 1 bộ ảnh (cả hai chiều)
+        single_set_width = len(self.photos) * (self.photo_width + self.spacing)
+        self.current_offset = (self.current_offset + self.scroll_speed * dt) % single_set_width
+        self.update()
+
+    def paintEvent(self, event):
+        """Vẽ các ô ảnh đang nằm trong vùng hiển thị."""
         if not self.photos:
             return
         
-        # Nhân đôi ảnh để tạo hiệu ứng vòng lặp liền mạch
-        total_photos = self.photos * 3  # Nhân 3 lần để có đủ ảnh cho vòng lặp
-        
-        for i, photo_path in enumerate(total_photos):
-            label = QLabel(self)
-            label.setFixedSize(self.photo_width, self.photo_height)
-            label.setAlignment(Qt.AlignCenter)
-            label.setStyleSheet("""
-                QLabel {
-                    background: qlineargradient(x1:0, y1:0, x2:1, y2:1,
-                        stop:0 #2d2d44, stop:1 #1a1a2e);
-                    border: 3px solid #4361ee;
-                    border-radius: 15px;
-                    padding: 5px;
-                }
-            """)
-            
-            # Load và scale ảnh
-            img = cv2.imread(photo_path)
-            if img is not None:
-                qt_img = convert_cv_qt(img)
-                scaled = qt_img.scaled(
-                    self.photo_width - 16, 
-                    self.photo_height - 16, 
-                    Qt.KeepAspectRatio, 
-                    Qt.SmoothTransformation
-                )
-                label.setPixmap(scaled)
-            
-            label.show()
-            self.photo_labels.append(label)
-        
-        self.update_positions()
-    
-    def update_positions(self):
-        """Cập nhật vị trí các ảnh."""
-        if not self.photo_labels:
-            return
-            
+        with perf_monitor.timer("carousel.paint"):
+            self.paint_tiles()
+
+    def paint_tiles(self):
+        """Vẽ các ô đang nhìn thấy bằng pixmap đã dựng sẵn."""
+        painter = QPainter(self)
+        step = self.photo_width + self.spacing
         y_pos = 20
-        total_width = len(self.photo_labels) * (self.photo_width + self.spacing)
-        
-        for i, label in enumerate(self.photo_labels):
-            x_pos = i * (self.photo_width + self.spacing) - self.current_offset
-            label.move(int(x_pos), y_pos)
-    
-    def update_scroll(self):
-        """Cập nhật vị trí scroll."""
-        if not self.photo_labels or not self.photos:
+        offset = int(self.current_offset)
+        index = offset // step
+        x_pos = index * step - offset
+        while x_pos < self.width():
+            painter.drawPixmap(x_pos, y_pos, self.tile_pixmap(self.photos[index % len(self.photos)]))
+            x_pos += step
+            index += 1
+        painter.end()
+
+    def tile_pixmap(self, photo_path):
+        """QPixmap của cả ô ảnh, vẽ một lần rồi lấy từ cache."""
+        tile = self._tiles.get(photo_path)
+        if tile is not None:
+            self._tiles.move_to_end(photo_path)
+            return tile
+        
+        if self.submit is None:
+            pixmap = self.thumbnail_cache.get(photo_path)
+        else:
+            pixmap = self.thumbnail_cache.peek(photo_path)
+            if pixmap is None:
+                # Không giải mã trong paintEvent: vẽ ô trống, đọc nền rồi vẽ lại
+                self.thumbnail_cache.request(photo_path, self.submit, self.on_thumbnail_loaded)
+                if self._placeholder is None:
+                    self._placeholder = self.draw_tile(None)
+                return self._placeholder
+        
+        tile = self.draw_tile(pixmap)
+        self._tiles[photo_path] = tile
+        if len(self._tiles) > self.tile_capacity:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def on_thumbnail_loaded(self, photo_path):
+        """Thumbnail vừa đọc xong ở luồng nền: vẽ lại ô."""
+        self._tiles.pop(photo_path, None)
+        self.update()
+
+    def draw_tile(self, pixmap):
+        """Vẽ một ô ảnh: nền gradient, viền bo góc và thumbnail pixmap ở giữa (None = ô trống)."""
+        tile = QPixmap(self.photo_width, self.photo_height)
+        tile.fill(Qt.transparent)
+        painter = QPainter(tile)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        
+        rect = QRectF(1.5, 1.5, self.photo_width - 3, self.photo_height - 3)
+        gradient = QLinearGradient(rect.topLeft(), rect.bottomRight())
+        gradient.setColorAt(0, QColor("#2d2d44"))
+        gradient.setColorAt(1, QColor("#1a1a2e"))
+        painter.setBrush(gradient)
+        painter.setPen(QPen(QColor("#4361ee"), 3))
+        painter.drawRoundedRect(rect, 15, 15)
+        
+        if pixmap is not None and not pixmap.isNull():
+            px = (self.photo_width - pixmap.width()) // 2
+            py = (self.photo_height - pixmap.height()) // 2
+            painter.drawPixmap(px, py, pixmap)
+        painter.end()
+        return tile
+
+# ==========================================
+# OVERLAY HIỆU NĂNG (PERFORMANCE OVERLAY)
+# ==========================================
+
+class PerfOverlay(QLabel):
+    """Bảng FPS và thời gian từng bước, vẽ đè lên góc cửa sổ; chỉ cập nhật khi đang hiện."""
+
+    def __init__(self, monitor, stats_source=None, parent=None):
+        super().__init__(parent)
+        self.monitor = monitor
+        self.stats_source = stats_source  # Hàm trả về dict thống kê camera (CameraWorker.stats)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("""
+            background-color: rgba(0, 0, 0, 190);
+            color: #06d6a0;
+            font-family: 'Consolas', 'DejaVu Sans Mono', monospace;
+            font-size: 13px;
+            padding: 8px;
+        """)
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def toggle(self):
+        """Bật/tắt overlay."""
+        if self.isVisible():
+            self.refresh_timer.stop()
+            self.hide()
+        else:
+            self.refresh()
+            self.show()
+            self.raise_()
+            self.refresh_timer.start(500)
+
+    def refresh(self):
+        """Vẽ lại bảng thống kê."""
+        lines = [f"Hiển thị {self.monitor.fps('preview'):5.1f} FPS"]
+        if self.stats_source is not None:
+            stats = self.stats_source()
+            lines[0] += (f" | camera {stats.get('fps', 0):5.1f} FPS | bỏ {stats.get('dropped', 0)}"
+                         f" | lỗi đọc {stats.get('read_failures', 0)}")
+        lines.append(f"{'bước':<26}{'n':>5}{'p50':>8}{'p90':>8}{'max':>8}  (ms)")
+        for name, stats in self.monitor.snapshot().items():
+            lines.append(f"{name:<26}{stats['count']:>5}{stats['p50']:>8.2f}{stats['p90']:>8.2f}{stats['max']:>8.1f}")
+        self.setText("\n".join(lines))
+        self.adjustSize()
+
+# ==========================================
+# BÁO CÁO KHỞI ĐỘNG (STARTUP REPORT)
+# ==========================================
+
+class StartupReport:
+    """Đo thời gian các bước khởi động và ghi log bảng phân rã (ms) khi mọi bước nền đã xong."""
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self._last = self.start
+        self.steps = []       # (tên, ms) các bước tuần tự trên luồng GUI
+        self.background = []  # (tên, ms chạy, ms từ lúc khởi động tới khi xong)
+        self.pending = set()
+
+    def mark(self, name):
+        """Ghi bước tuần tự name: thời gian từ mốc trước tới bây giờ."""
+        now = time.perf_counter()
+        self.steps.append((name, (now - self._last) * 1000))
+        self._last = now
+
+    def expect(self, *names):
+        """Khai báo các bước chạy nền phải xong trước khi in báo cáo."""
+        self.pending.update(names)
+
+    def done(self, name, duration_ms=None):
+        """Ghi bước nền name đã xong; in báo cáo khi không còn bước nào chờ."""
+        if name not in self.pending:
             return
-        
-        self.current_offset += self.scroll_speed
-        
-        # Reset offset khi đã cuộn qua 1 bộ ảnh
-        single_set_width = len(self.photos) * (self.photo_width + self.spacing)
-        if self.current_offset >= single_set_width:
-            self.current_offset = 0
-        
-        self.update_positions()
+        ready_ms = (time.perf_counter() - self.start) * 1000
+        self.background.append((name, duration_ms, ready_ms))
+        self.pending.discard(name)
+        if not self.pending:
+            self.report()
+
+    def report(self):
+        """Ghi log bảng thời gian khởi động."""
+        lines = ["Thời gian khởi động (ms):"]
+        for name, ms in self.steps:
+            lines.append(f"  {name:<30}{ms:9.1f}")
+        lines.append(f"  {'=> cửa sổ sẵn sàng':<30}{(self._last - self.start) * 1000:9.1f}")
+        for name, duration_ms, ready_ms in self.background:
+            duration = f"{duration_ms:9.1f}" if duration_ms is not None else " " * 9
+            lines.append(f"  {'[nền] ' + name:<30}{duration}  (xong lúc {ready_ms:.0f})")
+        logger.info("\n".join(lines))
 
 # ==========================================
 # GIAO DIỆN CHÍNH (MAIN GUI)
 # ==========================================
 
 class PhotoboothApp(QMainWindow):
-    def __init__(self):
+    def __init__(self, startup=None):
         super().__init__()
+        self.startup = startup if startup is not None else StartupReport()
         self.setWindowTitle(WINDOW_TITLE)
         self.resize(WINDOW_WIDTH, WINDOW_HEIGHT)
         
@@ -401,23 +2450,59 @@ class PhotoboothApp(QMainWindow):
 
         # --- STATE MANAGEMENT ---
         self.state = "START"  # START, PRICE_SELECT, QR_PAYMENT, CAPTURING, PHOTO_SELECT, TEMPLATE_SELECT, CONFIRM, PRINTING
-        self.captured_photos = []
+        self.captured_photos = CaptureStore()
+        self.capture_session_id = 0
         self.selected_frame_count = 0  # 2 hoặc 4
+        self.selected_layout = None  # Khoá COLLAGE_LAYOUTS của gói đã chọn
         self.selected_photo_indices = []
         self.collage_image = None
+        self.collage_canvas = None
         self.merged_image = None
-        self.current_frame = None
-        self.countdown_val = 0
+        self.merged_buffer = None
+        self.selected_template = None
+        
+        # Kết quả dựng trước trong lúc khách chọn ảnh
+        self.slot_images = {}          # chỉ số ảnh -> {(rộng, cao) ô: ảnh đã resize}
+        self.slot_pending = set()      # chỉ số ảnh đang được resize ở luồng nền
+        self.speculative_key = None    # bộ ảnh đang/đã được dựng trước
+        self.speculative_result = None # (bộ ảnh, collage, {template: ảnh ghép})
+        self.template_previews = {}    # template -> ảnh ghép sẵn của phiên hiện tại
+        
+        # Buffer chuyển đổi ảnh sang Qt, cấp phát lại chỉ khi kích thước khung đổi
+        self.camera_converter = FrameConverter()
+        self.preview_converter = FrameConverter()
+        self.live_overlay = None  # (khóa, compositor) overlay camera đang dùng
         self.selected_price_type = 0  # 2 hoặc 4
         self.payment_confirmed = False
         
         # Ảnh mẫu cho gallery
-        self.gallery_photos = load_sample_photos()
-        
-        # --- CAMERA ---
-        self.cap = cv2.VideoCapture(CAMERA_INDEX)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+        self.gallery = GalleryIndex()
+        self.gallery_photos = self.gallery.photos
+        
+        self.startup.expect("mở camera", "dựng các màn hình", "thumbnail gallery", "templates", "mã QR")
+        
+        # --- XỬ LÝ NỀN ---
+        self.task_runner = TaskRunner()
+        self.captured_photos.submit = self.task_runner.submit
+        
+        # --- LUỒNG CAMERA ---
+        # Camera được mở và dò chế độ ngay trên luồng camera, song song với việc dựng giao diện;
+        # GUI chỉ nhận frame mới nhất
+        self.camera_mode = None
+        self.still_pending = set()
+        self.burst_pending = set()
+        self.thumbnail_requests = {}  # chỉ số ảnh -> số thứ tự yêu cầu thumbnail mới nhất
+        self._thumbnail_seq = itertools.count()
+        self.camera_worker = CameraWorker(ring_size=CAMERA_RING_SIZE, still_mode=CAMERA_STILL_MODE,
+                                          opener=self.open_cameras, burst_frames=BURST_FRAMES,
+                                          burst_before=BURST_BEFORE)
+        self.camera_worker.camera_opened.connect(self.on_camera_opened)
+        self.camera_worker.frame_ready.connect(self.update_camera_frame)
+        self.camera_worker.still_ready.connect(self.on_still_ready)
+        self.camera_worker.frame_captured.connect(self.on_frame_captured)
+        self.camera_worker.burst_ready.connect(self.on_burst_ready)
+        self.camera_worker.start()
+        self.startup.mark("khởi tạo trạng thái")
 
         # --- MAIN LAYOUT ---
         self.central_widget = QWidget()
@@ -430,25 +2515,190 @@ class PhotoboothApp(QMainWindow):
         self.stacked = QStackedWidget()
         self.main_layout.addWidget(self.stacked)
 
-        # Tạo các màn hình (bỏ màn hình chọn kiểu khung)
+        # Chỉ dựng màn hình welcome trước khi hiện cửa sổ; các màn hình sau (bỏ màn hình
+        # chọn kiểu khung) được dựng lần lượt khi event loop rảnh, hoặc ngay khi cần đến
         self.create_welcome_screen()      # Index 0 - Màn hình welcome mới
-        self.create_price_select_screen() # Index 1 - Chọn giá tiền
-        self.create_qr_payment_screen()   # Index 2 - Hiển thị QR
-        self.create_capture_screen()      # Index 3
-        self.create_photo_select_screen() # Index 4
-        self.create_template_select_screen() # Index 5
-        self.create_confirm_screen()      # Index 6
+        self.startup.mark("màn hình welcome")
+        self.pending_screens = [
+            self.create_price_select_screen,    # Index 1 - Chọn giá tiền
+            self.create_qr_payment_screen,      # Index 2 - Hiển thị QR
+            self.create_capture_screen,         # Index 3
+            self.create_photo_select_screen,    # Index 4
+            self.create_template_select_screen, # Index 5
+            self.create_confirm_screen,         # Index 6
+        ]
+        self.screen_build_ms = 0.0
+        QTimer.singleShot(0, self.build_next_screen)
+
+        # --- MÁY IN ---
+        self.printer_service = PrinterService(create_printer_backend())
+        self.printer_service.start()
+
+        # --- HÀNG ĐỢI IN ---
+        self.print_queue = PrintQueue(self.printer_service)
+        self.print_queue.job_updated.connect(self.on_print_job_updated)
+        self.print_queue.start()
 
         # --- TIMER ---
-        self.camera_timer = QTimer()
-        self.camera_timer.timeout.connect(self.update_camera_frame)
-        self.camera_timer.start(30)
-
-        self.countdown_timer = QTimer()
-        self.countdown_timer.timeout.connect(self.countdown_tick)
-
-        # Load templates
-        self.templates = self.load_templates()
+        self.capture_scheduler = CaptureScheduler(PHOTOS_TO_TAKE, FIRST_PHOTO_DELAY, BETWEEN_PHOTO_DELAY)
+        self.capture_scheduler.countdown.connect(self.on_countdown)
+        self.capture_scheduler.shot_due.connect(self.on_shot_due)
+
+        # --- TIẾT KIỆM ĐIỆN ---
+        # Bật/tắt camera và animation theo màn hình đang hiển thị; giảm FPS màn hình chờ khi không ai dùng
+        self.idle = False
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(IDLE_TIMEOUT * 1000)
+        self.idle_timer.timeout.connect(self.on_idle)
+        self.stacked.currentChanged.connect(self.apply_power_policy)
+        QApplication.instance().installEventFilter(self)
+        self.apply_power_policy()
+
+        # --- ĐO HIỆU NĂNG ---
+        # Overlay ẩn, bật bằng F12 hoặc chạm liên tiếp vào góc trên bên trái
+        self.perf_overlay = PerfOverlay(perf_monitor, self.camera_worker.stats, self)
+        self.perf_overlay.move(10, 10)
+        self.corner_taps = deque(maxlen=PERF_OVERLAY_TAPS)
+        self.last_tap_time = None
+        self.session_print_job = None
+
+        # Load templates ở luồng nền (giải mã và resize sẵn theo kích thước collage)
+        self.template_cache = TemplateCache()
+        self.templates = []
+        self.task_runner.submit(self.preload_templates, callback=self.on_templates_loaded)
+        self.task_runner.submit(self.preload_qr_codes, callback=self.on_qr_codes_loaded)
+        self.startup.mark("máy in, timer")
+
+    def open_cameras(self):
+        """Mở camera xem trước và camera chụp riêng (nếu có); chạy trên luồng camera."""
+        start = time.perf_counter()
+        # Mở lại sau khi đã đóng lúc rảnh: chỉ thử lại chế độ đã dò được
+        mode = self.camera_mode
+        modes = [(mode.width, mode.height, mode.fps)] if mode is not None else CAMERA_MODES
+        cap, mode = open_camera(CAMERA_INDEX, modes)
+        still_cap = None
+        if CAMERA_STILL_SOURCE is not None:
+            # Luồng thứ hai chỉ dùng để chụp, không cần đạt FPS xem trước
+            still_modes = [CAMERA_STILL_MODE + (15,)] if CAMERA_STILL_MODE else CAMERA_MODES
+            still_cap, _ = open_camera(CAMERA_STILL_SOURCE, still_modes)
+        self.camera_open_ms = (time.perf_counter() - start) * 1000
+        return cap, still_cap, mode
+
+    def on_camera_opened(self, mode):
+        """Camera đã mở xong trên luồng camera."""
+        self.camera_mode = mode
+        # Kho ảnh cấp phát theo kích thước ảnh chụp độ phân giải cao
+        self.captured_photos.frame_shape = self.camera_worker.still_shape()
+        self.startup.done("mở camera", self.camera_open_ms)
+
+    # Màn hình cần camera: QR thanh toán (làm nóng camera trước) và chụp ảnh
+    CAMERA_SCREENS = (2, 3)
+    ACTIVITY_EVENTS = (QEvent.MouseButtonPress, QEvent.TouchBegin, QEvent.KeyPress)
+
+    def apply_power_policy(self, index=None):
+        """Chỉ chạy camera và animation carousel ở màn hình cần đến chúng."""
+        index = self.stacked.currentIndex() if index is None else index
+        
+        # Carousel chỉ nằm ở màn hình welcome
+        if index == 0:
+            self.animation_clock.start()
+            self.idle_timer.start()
+        else:
+            self.animation_clock.stop()
+            self.idle_timer.stop()
+        
+        # Camera: vẫn đọc khi còn chờ ảnh độ phân giải cao của phiên
+        needs_camera = index in self.CAMERA_SCREENS or self.state == "CAPTURING" or bool(self.still_pending)
+        if CAMERA_IDLE_MODE == "stream" or needs_camera:
+            self.camera_worker.set_active(True)
+        else:
+            self.camera_worker.set_active(False, release=CAMERA_IDLE_MODE == "release")
+
+    def eventFilter(self, obj, event):
+        """Theo dõi thao tác của khách để thoát chế độ chờ và cử chỉ mở overlay hiệu năng."""
+        if event.type() in self.ACTIVITY_EVENTS:
+            self.on_user_activity()
+            if event.type() == QEvent.KeyPress and event.key() == Qt.Key_F12 and not event.isAutoRepeat():
+                self.perf_overlay.toggle()
+            elif event.type() == QEvent.MouseButtonPress:
+                self.on_corner_tap(event)
+        return False
+
+    def on_corner_tap(self, event):
+        """Đếm các lần chạm vào góc trên bên trái; đủ PERF_OVERLAY_TAPS lần trong 3 giây thì bật/tắt overlay."""
+        # Một lần chạm có thể đi qua bộ lọc nhiều lần khi lan lên widget cha
+        if event.timestamp() == self.last_tap_time:
+            return
+        self.last_tap_time = event.timestamp()
+        pos = self.mapFromGlobal(event.globalPos())
+        if pos.x() > PERF_OVERLAY_CORNER or pos.y() > PERF_OVERLAY_CORNER:
+            self.corner_taps.clear()
+            return
+        now = time.monotonic()
+        self.corner_taps.append(now)
+        if len(self.corner_taps) == PERF_OVERLAY_TAPS and now - self.corner_taps[0] <= 3.0:
+            self.corner_taps.clear()
+            self.perf_overlay.toggle()
+
+    def on_user_activity(self):
+        """Có người chạm màn hình: trở lại tốc độ animation bình thường."""
+        if self.idle:
+            self.idle = False
+            self.animation_clock.set_interval(ANIMATION_INTERVAL)
+        if self.idle_timer.isActive():
+            self.idle_timer.start()
+
+    def on_idle(self):
+        """Lâu không có thao tác ở màn hình chờ: giảm FPS carousel."""
+        self.idle = True
+        self.animation_clock.set_interval(IDLE_ANIMATION_INTERVAL)
+
+    def build_next_screen(self):
+        """Dựng màn hình tiếp theo còn thiếu, mỗi lượt event loop một màn hình."""
+        if not self.pending_screens:
+            return
+        start = time.perf_counter()
+        self.pending_screens.pop(0)()
+        self.screen_build_ms += (time.perf_counter() - start) * 1000
+        if self.pending_screens:
+            QTimer.singleShot(0, self.build_next_screen)
+        else:
+            self.startup.done("dựng các màn hình", self.screen_build_ms)
+
+    def ensure_screens(self):
+        """Dựng ngay các màn hình còn thiếu (khi khách bấm trước lúc dựng nền xong)."""
+        while self.pending_screens:
+            self.build_next_screen()
+
+    def preload_templates(self):
+        """Giải mã templates và tạo sẵn compositor; chạy ở luồng nền."""
+        start = time.perf_counter()
+        paths = self.template_cache.refresh()
+        self.template_cache.preload(PREVIEW_SIZE)
+        return paths, (time.perf_counter() - start) * 1000
+
+    def preload_qr_codes(self):
+        """Mã hóa sẵn mã QR của các gói; chạy ở luồng nền."""
+        start = time.perf_counter()
+        contents = [package_qr_content(count) for count in PACKAGES]
+        for content in contents:
+            qr_code_modules(content)
+        return contents, (time.perf_counter() - start) * 1000
+
+    def on_qr_codes_loaded(self, result):
+        """Tạo sẵn QPixmap mã QR của các gói (trên luồng GUI)."""
+        contents, duration_ms = result
+        for content in contents:
+            generate_qr_code(content)
+        self.startup.done("mã QR", duration_ms)
+
+    def on_templates_loaded(self, result):
+        """Nhận danh sách templates đã nạp ở luồng nền."""
+        paths, duration_ms = result
+        if not self.templates:
+            self.templates = paths
+        self.startup.done("templates", duration_ms)
 
     # ==========================================
     # TẠO CÁC MÀN HÌNH
@@ -481,14 +2731,20 @@ class PhotoboothApp(QMainWindow):
         subtitle.setStyleSheet("color: #a8dadc; font-size: 16px;")
         gallery_layout.addWidget(subtitle)
         
+        # Cache thumbnail và đồng hồ animation dùng chung cho cả hai hàng carousel
+        self.thumbnail_cache = ThumbnailCache(CAROUSEL_THUMB_SIZE)
+        self.animation_clock = AnimationClock()
+        
         # Carousel widget - Hàng 1
-        self.carousel1 = CarouselPhotoWidget()
-        self.carousel1.scroll_speed = 2
+        self.carousel1 = CarouselPhotoWidget(thumbnail_cache=self.thumbnail_cache, clock=self.animation_clock,
+                                             submit=self.task_runner.submit)
+        self.carousel1.scroll_speed = CAROUSEL_SCROLL_SPEED
         gallery_layout.addWidget(self.carousel1)
         
         # Carousel widget - Hàng 2 (ngược chiều)
-        self.carousel2 = CarouselPhotoWidget()
-        self.carousel2.scroll_speed = -2  # Ngược chiều
+        self.carousel2 = CarouselPhotoWidget(thumbnail_cache=self.thumbnail_cache, clock=self.animation_clock,
+                                             submit=self.task_runner.submit)
+        self.carousel2.scroll_speed = -CAROUSEL_SCROLL_SPEED  # Ngược chiều
         gallery_layout.addWidget(self.carousel2)
         
         # Thông tin bổ sung
@@ -565,24 +2821,74 @@ class PhotoboothApp(QMainWindow):
         info_label.setStyleSheet("color: #a8dadc; font-size: 14px;")
         start_layout.addWidget(info_label)
         
+        # Trạng thái các lệnh in đang chạy nền
+        self.print_status_label = QLabel("")
+        self.print_status_label.setAlignment(Qt.AlignCenter)
+        self.print_status_label.setWordWrap(True)
+        self.print_status_label.setStyleSheet("color: #a8dadc; font-size: 14px;")
+        start_layout.addWidget(self.print_status_label)
+        
         main_layout.addWidget(start_panel, stretch=1)
         
         self.stacked.addWidget(screen)
         
         # Load ảnh cho carousel
         self.load_carousel_photos()
+        self.animation_clock.start()
 
     def load_carousel_photos(self):
-        """Load ảnh vào carousel."""
-        if self.gallery_photos:
-            # Chia ảnh thành 2 hàng
-            half = len(self.gallery_photos) // 2
-            self.carousel1.set_photos(self.gallery_photos[:max(half, 4)])
-            self.carousel2.set_photos(self.gallery_photos[half:] if half > 0 else self.gallery_photos[:4])
+        """Đọc sẵn thumbnail các ô đầu của hai hàng ở luồng nền, xong mới đưa ảnh vào carousel."""
+        cache = self.thumbnail_cache
+        gallery = list(self.gallery_photos)
+        # Các ô sau được carousel tự đọc nền khi cuộn tới
+        photos = []
+        for row in self.carousel_rows(gallery):
+            photos.extend(path for path in row[:CAROUSEL_PRELOAD_TILES] if path not in photos)
+        photos = photos[:cache.capacity]
+        
+        def load_thumbnails():
+            start = time.perf_counter()
+            removed = cache.prune(gallery)
+            if removed:
+                logger.info("Đã xóa %d thumbnail cũ trong %s", removed, cache.cache_dir)
+            thumbs = [(path, cache.load(path)) for path in photos]
+            return thumbs, (time.perf_counter() - start) * 1000
+        
+        def on_loaded(result):
+            thumbs, duration_ms = result
+            for path, thumb in thumbs:
+                if thumb is not None:
+                    cache.store(path, thumb)
+            self.show_carousel_photos()
+            self.startup.done("thumbnail gallery", duration_ms)
+        
+        self.task_runner.submit(load_thumbnails, callback=on_loaded)
+
+    @staticmethod
+    def carousel_rows(photos):
+        """Chia danh sách ảnh gallery thành ảnh của hai hàng carousel."""
+        if not photos:
+            return [], []
+        half = len(photos) // 2
+        return photos[:max(half, 4)], (photos[half:] if half > 0 else photos[:4])
+
+    def show_carousel_photos(self):
+        """Chia ảnh gallery vào hai hàng carousel."""
+        row1, row2 = self.carousel_rows(self.gallery_photos)
+        self.carousel1.set_photos(row1)
+        self.carousel2.set_photos(row2)
+
+    def add_gallery_photo(self, path, image=None):
+        """Thêm ảnh vừa lưu vào gallery và carousel ngắn hơn, không quét lại thư mục."""
+        if not self.gallery.add(path):
+            return
+        if image is not None:
+            # Tạo thumbnail từ ảnh trong bộ nhớ, không phải giải mã lại file JPEG
+            self.thumbnail_cache.put(path, image)
+        if len(self.carousel1.photos) <= len(self.carousel2.photos):
+            self.carousel1.add_photo(path)
         else:
-            # Tạo ảnh mẫu nếu không có
-            self.carousel1.set_photos([])
-            self.carousel2.set_photos([])
+            self.carousel2.add_photo(path)
 
     def create_price_select_screen(self):
         """Màn hình chọn giá tiền (2 ảnh hoặc 4 ảnh)."""
@@ -814,6 +3120,38 @@ class PhotoboothApp(QMainWindow):
         self.photo_grid_widget = QWidget()
         self.photo_grid_layout = QGridLayout(self.photo_grid_widget)
         self.photo_grid_layout.setSpacing(15)
+        
+        # Tạo grid ảnh (2 hàng x 5 cột) một lần, dùng lại cho mọi phiên
+        self.photo_cards = []
+        self.photo_buttons = []
+        for idx in range(PHOTOS_TO_TAKE):
+            container = QWidget()
+            container.setObjectName("PhotoCard")
+            container.setFixedSize(200, 150)
+            
+            card_layout = QVBoxLayout(container)
+            card_layout.setContentsMargins(5, 5, 5, 5)
+            card_layout.setSpacing(5)
+            
+            btn = QPushButton()
+            btn.setCheckable(True)
+            btn.setFixedSize(*PHOTO_THUMB_SIZE)
+            btn.setIconSize(QSize(*PHOTO_THUMB_SIZE))
+            btn.setStyleSheet("border: 2px solid transparent; border-radius: 5px;")
+            btn.clicked.connect(lambda checked, i=idx, b=btn: self.toggle_photo(i, b))
+            card_layout.addWidget(btn)
+            
+            lbl = QLabel(f"Ảnh {idx + 1}")
+            lbl.setAlignment(Qt.AlignCenter)
+            lbl.setStyleSheet("font-size: 14px;")
+            card_layout.addWidget(lbl)
+            
+            row = idx // 5
+            col = idx % 5
+            self.photo_grid_layout.addWidget(container, row, col)
+            self.photo_cards.append(container)
+            self.photo_buttons.append(btn)
+        
         scroll.setWidget(self.photo_grid_widget)
         layout.addWidget(scroll, stretch=1)
 
@@ -927,6 +3265,7 @@ class PhotoboothApp(QMainWindow):
 
     def go_to_price_select(self):
         """Chuyển sang màn hình chọn giá tiền."""
+        self.ensure_screens()
         self.state = "PRICE_SELECT"
         self.stacked.setCurrentIndex(1)
 
@@ -934,19 +3273,13 @@ class PhotoboothApp(QMainWindow):
         """Xử lý khi chọn gói giá tiền."""
         self.selected_price_type = photo_count
         self.selected_frame_count = photo_count
+        self.selected_layout = PACKAGES[photo_count].get("layout", photo_count)
         
         # Cập nhật thông tin trên màn hình QR
-        if photo_count == 2:
-            self.selected_package_label.setText(f"📦 GÓI 2 ẢNH - {PRICE_2_PHOTOS}")
-            qr_amount = "20000"
-        else:
-            self.selected_package_label.setText(f"📦 GÓI 4 ẢNH - {PRICE_4_PHOTOS}")
-            qr_amount = "35000"
+        self.selected_package_label.setText(f"📦 GÓI {photo_count} ẢNH - {PACKAGES[photo_count]['price']}")
         
-        # Tạo QR code
-        qr_content = f"https://momosv3.apimienphi.com/api/QRCode?phone=0123456789&amount={qr_amount}&note=Photobooth{photo_count}Anh"
-        qr_pixmap = generate_qr_code(qr_content, 300)
-        self.qr_label.setPixmap(qr_pixmap)
+        # Mã QR đã được tạo sẵn lúc khởi động (lấy từ cache)
+        self.qr_label.setPixmap(generate_qr_code(package_qr_content(photo_count)))
         
         # Chuyển sang màn hình QR
         self.state = "QR_PAYMENT"
@@ -958,75 +3291,166 @@ class PhotoboothApp(QMainWindow):
         self.start_capture_session()
 
     def load_templates(self):
-        """Load danh sách templates."""
-        templates = []
-        if os.path.exists(TEMPLATE_DIR):
-            for f in os.listdir(TEMPLATE_DIR):
-                if f.lower().endswith('.png'):
-                    templates.append(os.path.join(TEMPLATE_DIR, f))
-        return templates
+        """Load danh sách templates (chỉ giải mã lại file mới hoặc đã thay đổi)."""
+        return self.template_cache.refresh()
 
     def update_camera_frame(self):
-        """Cập nhật frame từ camera."""
+        """Cập nhật frame từ camera (frame đã được lật sẵn trên luồng camera)."""
+        frame, _ = self.camera_worker.latest_frame()
         if self.state == "CAPTURING":
-            ret, frame = self.cap.read()
-            if ret:
-                frame = cv2.flip(frame, 1)
-                self.current_frame = frame.copy()
-                
-                # Hiển thị lên camera label
-                qt_img = convert_cv_qt(frame)
-                scaled = qt_img.scaled(self.camera_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                self.camera_label.setPixmap(scaled)
+            if frame is not None:
+                perf_monitor.mark("preview")
+                # Hiển thị lên camera label (không copy frame, chỉ resize vào buffer hiển thị)
+                size = self.camera_label.size()
+                with perf_monitor.timer("preview.scale"):
+                    display = self.camera_converter.resize(frame, size.width(), size.height())
+                overlay = self.get_live_overlay(display.shape[1], display.shape[0])
+                if overlay is not None:
+                    with perf_monitor.timer("preview.overlay"):
+                        overlay.composite(display, out=display)
+                with perf_monitor.timer("preview.convert"):
+                    self.camera_label.setPixmap(self.camera_converter.wrap(display))
+
+    def get_live_overlay(self, width, height):
+        """Compositor overlay cho camera ở kích thước hiển thị, dựng lại khi khung hoặc gói thay đổi."""
+        if not LIVE_OVERLAY or self.selected_layout not in COLLAGE_LAYOUTS:
+            return None
+        template_path = LIVE_OVERLAY_TEMPLATE or (self.templates[0] if self.templates else None)
+        key = (width, height, self.selected_layout, template_path)
+        if self.live_overlay is None or self.live_overlay[0] != key:
+            layout = get_collage_layout(self.selected_layout, PREVIEW_SIZE)
+            template = self.template_cache.image(template_path) if template_path else None
+            self.live_overlay = (key, build_live_overlay((width, height), layout, template))
+        return self.live_overlay[1]
 
     def start_capture_session(self):
         """Bắt đầu phiên chụp ảnh."""
         self.state = "CAPTURING"
-        self.captured_photos = []
+        self.captured_photos.clear()
+        self.capture_session_id += 1
+        self.still_pending = set()
+        self.burst_pending = set()
+        self.clear_speculative()
+        self.session_print_job = None
+        perf_monitor.begin_session(self.capture_session_id, package=self.selected_frame_count,
+                                   camera_mode=self.camera_mode._asdict() if self.camera_mode else None)
+        for btn in self.photo_buttons:
+            btn.setIcon(QIcon())
         self.selected_photo_indices = []
         
         # Chuyển sang màn hình chụp
         self.stacked.setCurrentIndex(3)
         
-        # Bắt đầu đếm ngược cho ảnh đầu tiên (10 giây)
-        self.countdown_val = FIRST_PHOTO_DELAY
+        # Lịch chụp: ảnh đầu sau FIRST_PHOTO_DELAY giây, các ảnh sau cách nhau BETWEEN_PHOTO_DELAY giây.
+        # Luồng camera được hẹn trước mọi deadline nên frame được chọn đúng lúc dù GUI bận.
         self.photo_count_label.setText(f"Ảnh: 0/{PHOTOS_TO_TAKE}")
         self.status_label.setText("Chuẩn bị tạo dáng!")
-        self.countdown_label.setText(str(self.countdown_val))
-        
-        self.countdown_timer.start(1000)
+        self.camera_worker.cancel_captures()
+        for index, deadline in enumerate(self.capture_scheduler.start()):
+            self.camera_worker.schedule_capture(deadline, (self.capture_session_id, index))
+
+    def on_countdown(self, seconds):
+        """Hiển thị số giây còn lại tới ảnh tiếp theo."""
+        self.countdown_label.setText(str(seconds))
+
+    def on_shot_due(self, index, deadline):
+        """Tới hạn chụp ảnh index (frame do luồng camera chọn và gửi về on_frame_captured)."""
+        self.countdown_label.setText("📸")
+
+    def on_frame_captured(self, frame, timestamp, token):
+        """Lưu frame đã chụp đúng hạn vào kho ảnh của phiên."""
+        session_id, index = token
+        if session_id != self.capture_session_id or self.state != "CAPTURING":
+            return
+        # Ảnh xem trước giữ chỗ ngay; ảnh độ phân giải cao (nếu có) sẽ thay vào khi chụp xong
+        self.captured_photos.put(index, frame)
+        if self.camera_worker.has_still():
+            self.still_pending.add(index)
+        elif self.camera_worker.burst_enabled():
+            # Frame đúng hạn giữ chỗ; frame tốt nhất của burst sẽ thay vào sau khi chấm điểm
+            self.burst_pending.add(index)
+        self.request_photo_thumbnail(index)
+        photo_num = len(self.captured_photos)
+        self.photo_count_label.setText(f"Ảnh: {photo_num}/{PHOTOS_TO_TAKE}")
+        
+        if photo_num < PHOTOS_TO_TAKE:
+            self.status_label.setText(f"Đã chụp ảnh {photo_num}! Tiếp tục...")
+        else:
+            # Đã chụp đủ 10 ảnh
+            self.capture_scheduler.stop()
+            self.countdown_label.setText("✓")
+            self.status_label.setText("Hoàn thành!")
+            
+            # Chuyển thẳng sang chọn ảnh (bỏ qua chọn kiểu khung vì đã chọn trước)
+            QTimer.singleShot(1000, self.go_to_photo_select)
 
-    def countdown_tick(self):
-        """Xử lý mỗi giây đếm ngược."""
-        self.countdown_val -= 1
+    def on_burst_ready(self, frames, token):
+        """Chấm điểm burst ở luồng nền rồi thay ảnh của phiên bằng frame tốt nhất."""
+        session_id, index = token
+        if session_id != self.capture_session_id:
+            return
+        
+        def on_best(result):
+            if session_id != self.capture_session_id:
+                return
+            frame, position = result
+            self.burst_pending.discard(index)
+            self.captured_photos.put(index, frame)
+            self.request_photo_thumbnail(index)
+            logger.debug("Ảnh %d: chọn frame %d/%d của burst", index, position + 1, len(frames))
+            if self.state == "PHOTO_SELECT":
+                self.schedule_speculative_render()
+        
+        def on_error(error):
+            # Giữ frame đúng hạn đã lưu
+            if session_id != self.capture_session_id:
+                return
+            self.burst_pending.discard(index)
+            if self.state == "PHOTO_SELECT":
+                self.schedule_speculative_render()
         
-        if self.countdown_val > 0:
-            self.countdown_label.setText(str(self.countdown_val))
+        self.task_runner.submit(pick_best_frame, frames, callback=on_best, error_callback=on_error)
+
+    def on_still_ready(self, frame, token):
+        """Thay ảnh xem trước bằng ảnh chụp độ phân giải cao."""
+        session_id, index = token
+        if session_id != self.capture_session_id:
+            return
+        self.still_pending.discard(index)
+        if not self.still_pending:
+            self.apply_power_policy()
+        if frame is not None:
+            self.captured_photos.put(index, frame)
+            self.request_photo_thumbnail(index)
         else:
-            # Chụp ảnh!
-            self.countdown_label.setText("📸")
-            self.capture_photo()
-
-    def capture_photo(self):
-        """Chụp một ảnh."""
-        if self.current_frame is not None:
-            self.captured_photos.append(self.current_frame.copy())
-            photo_num = len(self.captured_photos)
-            self.photo_count_label.setText(f"Ảnh: {photo_num}/{PHOTOS_TO_TAKE}")
-            
-            if photo_num < PHOTOS_TO_TAKE:
-                # Còn ảnh cần chụp, đặt countdown 7 giây
-                self.countdown_val = BETWEEN_PHOTO_DELAY
-                self.countdown_label.setText(str(self.countdown_val))
-                self.status_label.setText(f"Đã chụp ảnh {photo_num}! Tiếp tục...")
-            else:
-                # Đã chụp đủ 10 ảnh
-                self.countdown_timer.stop()
-                self.countdown_label.setText("✓")
-                self.status_label.setText("Hoàn thành!")
-                
-                # Chuyển thẳng sang chọn ảnh (bỏ qua chọn kiểu khung vì đã chọn trước)
-                QTimer.singleShot(1000, self.go_to_photo_select)
+            logger.warning("Không chụp được ảnh độ phân giải cao, giữ ảnh xem trước %d", index)
+        if self.state == "PHOTO_SELECT":
+            self.schedule_speculative_render()
+
+    def request_photo_thumbnail(self, index):
+        """Tạo thumbnail cho ảnh vừa chụp ở luồng nền, gắn vào nút khi xong."""
+        session_id = self.capture_session_id
+        store = self.captured_photos
+        request = self.thumbnail_requests[index] = next(self._thumbnail_seq)
+        
+        def on_ready(q_img):
+            # Bỏ qua kết quả của phiên cũ, hoặc của yêu cầu cũ xong sau yêu cầu mới hơn
+            # (ví dụ thumbnail tạm trước khi chọn được frame tốt nhất của burst)
+            if session_id == self.capture_session_id and self.thumbnail_requests.get(index) == request:
+                self.photo_buttons[index].setIcon(QIcon(QPixmap.fromImage(q_img)))
+        
+        # Lấy bản của ảnh lúc này (slot có thể bị thay khi có ảnh độ phân giải cao / frame
+        # tốt nhất); chế độ "jpeg" vẫn giải mã trong luồng nền, không chặn GUI
+        read = store.reader(index)
+        self.task_runner.submit(lambda: make_photo_thumbnail(read()), callback=on_ready)
+
+    def clear_speculative(self):
+        """Bỏ các kết quả dựng trước của phiên cũ."""
+        self.slot_images = {}
+        self.slot_pending = set()
+        self.speculative_key = None
+        self.speculative_result = None
+        self.template_previews = {}
 
     def go_to_photo_select(self):
         """Chuyển sang màn hình chọn ảnh."""
@@ -1036,42 +3460,11 @@ class PhotoboothApp(QMainWindow):
         # Cập nhật title dựa trên gói đã chọn
         self.photo_select_title.setText(f"CHỌN {self.selected_frame_count} ẢNH CHO KHUNG {self.selected_frame_count} ẢNH")
         
-        # Clear grid cũ
-        for i in reversed(range(self.photo_grid_layout.count())):
-            self.photo_grid_layout.itemAt(i).widget().deleteLater()
-        
-        # Tạo grid ảnh (2 hàng x 5 cột)
-        self.photo_buttons = []
-        for idx, img in enumerate(self.captured_photos):
-            container = QWidget()
-            container.setObjectName("PhotoCard")
-            container.setFixedSize(200, 150)
-            
-            layout = QVBoxLayout(container)
-            layout.setContentsMargins(5, 5, 5, 5)
-            layout.setSpacing(5)
-            
-            btn = QPushButton()
-            btn.setCheckable(True)
-            btn.setFixedSize(180, 100)
-            
-            thumb = cv2.resize(img, (180, 100))
-            btn.setIcon(QIcon(convert_cv_qt(thumb)))
-            btn.setIconSize(QSize(180, 100))
+        # Dùng lại các ô có sẵn; thumbnail đã được tạo nền trong lúc chụp
+        for idx, (container, btn) in enumerate(zip(self.photo_cards, self.photo_buttons)):
+            btn.setChecked(False)
             btn.setStyleSheet("border: 2px solid transparent; border-radius: 5px;")
-            btn.clicked.connect(lambda checked, i=idx, b=btn: self.toggle_photo(i, b))
-            
-            layout.addWidget(btn)
-            
-            lbl = QLabel(f"Ảnh {idx + 1}")
-            lbl.setAlignment(Qt.AlignCenter)
-            lbl.setStyleSheet("font-size: 14px;")
-            layout.addWidget(lbl)
-            
-            row = idx // 5
-            col = idx % 5
-            self.photo_grid_layout.addWidget(container, row, col)
-            self.photo_buttons.append(btn)
+            container.setVisible(idx < len(self.captured_photos))
         
         self.btn_confirm_photos.setEnabled(False)
         self.stacked.setCurrentIndex(4)
@@ -1096,43 +3489,85 @@ class PhotoboothApp(QMainWindow):
         self.btn_confirm_photos.setEnabled(
             len(self.selected_photo_indices) == self.selected_frame_count
         )
+        
+        self.schedule_speculative_render()
+
+    def schedule_speculative_render(self):
+        """Resize sẵn các ảnh đã chọn ở luồng nền; khi chọn đủ thì dựng sẵn collage và các bản ghép."""
+        session_id = self.capture_session_id
+        store = self.captured_photos
+        layout = get_collage_layout(self.selected_layout, PREVIEW_SIZE)
+        
+        for index in self.selected_photo_indices:
+            # Ảnh đang chờ bản độ phân giải cao hoặc frame tốt nhất của burst sẽ được xử lý
+            # khi on_still_ready / on_burst_ready gọi lại
+            if (index in self.slot_images or index in self.slot_pending
+                    or index in self.still_pending or index in self.burst_pending):
+                continue
+            self.slot_pending.add(index)
+            
+            def on_slot_ready(prepared, index=index):
+                if session_id != self.capture_session_id:
+                    return
+                self.slot_pending.discard(index)
+                self.slot_images[index] = prepared
+                self.schedule_speculative_render()
+            
+            def on_slot_error(error, index=index):
+                # Không dựng trước được: confirm_photo_selection sẽ dựng trực tiếp
+                if session_id == self.capture_session_id:
+                    self.slot_pending.discard(index)
+            
+            self.task_runner.submit(lambda read=store.reader(index): prepare_slot_images(read(), layout),
+                                    callback=on_slot_ready, error_callback=on_slot_error)
+        
+        key = tuple(sorted(self.selected_photo_indices))
+        if (len(key) != self.selected_frame_count or key == self.speculative_key
+                or any(i not in self.slot_images for i in key)):
+            return
+        
+        self.speculative_key = key
+        slot_images = [self.slot_images[i][layout.slot_size(slot)] for slot, i in enumerate(key)]
+        
+        def on_render_ready(result):
+            if session_id == self.capture_session_id and key == self.speculative_key:
+                self.speculative_result = (key,) + result
+        
+        def on_render_error(error):
+            # Cho phép thử lại ở lần chọn ảnh sau
+            if session_id == self.capture_session_id and key == self.speculative_key:
+                self.speculative_key = None
+        
+        self.task_runner.submit(render_template_previews, slot_images, layout, self.template_cache,
+                                list(self.templates), callback=on_render_ready, error_callback=on_render_error)
 
     def confirm_photo_selection(self):
         """Xác nhận chọn ảnh và tạo collage."""
-        selected_imgs = [self.captured_photos[i] for i in sorted(self.selected_photo_indices)]
-        self.collage_image = self.create_collage(selected_imgs)
+        key = tuple(sorted(self.selected_photo_indices))
+        if self.speculative_result is not None and self.speculative_result[0] == key:
+            # Đã được dựng sẵn trong lúc khách chọn ảnh
+            _, self.collage_image, self.template_previews = self.speculative_result
+        else:
+            selected_imgs = [self.captured_photos[i] for i in key]
+            self.collage_image = self.create_collage(selected_imgs)
+            self.template_previews = {}
         self.merged_image = self.collage_image.copy()
+        self.selected_template = None
         
         self.go_to_template_select()
 
     def create_collage(self, images):
-        """Tạo collage từ các ảnh đã chọn (chỉ 2 hoặc 4 ảnh)."""
-        canvas = np.zeros((720, 1280, 3), dtype=np.uint8)
-        count = len(images)
-        
-        if count == 2:
-            # 2 ảnh: đặt cạnh nhau
-            for i, img in enumerate(images):
-                h, w = img.shape[:2]
-                center_x = w // 2
-                start_x = max(0, center_x - 320)
-                end_x = min(w, start_x + 640)
-                cropped = img[0:min(h, 720), start_x:end_x]
-                cropped = cv2.resize(cropped, (640, 720))
-                canvas[0:720, i*640:(i+1)*640] = cropped
-        elif count == 4:
-            # 4 ảnh: 2x2 grid
-            for i, img in enumerate(images):
-                resized = cv2.resize(img, (640, 360))
-                row = i // 2
-                col = i % 2
-                canvas[row*360:(row+1)*360, col*640:(col+1)*640] = resized
-        
-        return canvas
+        """Tạo collage xem trước (PREVIEW_SIZE) từ các ảnh đã chọn theo bố cục của gói đã chọn."""
+        layout = get_collage_layout(self.selected_layout, PREVIEW_SIZE)
+        # Canvas được giữ lại và dùng lại cho các phiên sau
+        with perf_monitor.timer("render.collage"):
+            self.collage_canvas = layout.render(images, out=self.collage_canvas)
+        return self.collage_canvas
 
     def go_to_template_select(self):
         """Chuyển sang màn hình chọn template."""
         self.state = "TEMPLATE_SELECT"
+        self.templates = self.load_templates()
         
         # Hiển thị preview ban đầu
         self.update_template_preview()
@@ -1144,9 +3579,8 @@ class PhotoboothApp(QMainWindow):
         for path in self.templates:
             btn = QPushButton()
             btn.setFixedSize(120, 100)
-            pix = QPixmap(path).scaled(100, 80, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            btn.setIcon(QIcon(pix))
-            btn.setIconSize(QSize(100, 80))
+            btn.setIcon(QIcon(self.template_cache.thumbnail(path)))
+            btn.setIconSize(QSize(*TEMPLATE_THUMB_SIZE))
             btn.setStyleSheet("""
                 background-color: #16213e; 
                 border: 2px solid #0f3460;
@@ -1160,24 +3594,32 @@ class PhotoboothApp(QMainWindow):
     def update_template_preview(self):
         """Cập nhật preview."""
         if self.merged_image is not None:
-            qt_img = convert_cv_qt(self.merged_image)
-            scaled = qt_img.scaled(
-                self.template_preview_label.size(), 
-                Qt.KeepAspectRatio, 
-                Qt.SmoothTransformation
-            )
-            self.template_preview_label.setPixmap(scaled)
+            pixmap = self.preview_converter.to_pixmap(self.merged_image, self.template_preview_label.size())
+            self.template_preview_label.setPixmap(pixmap)
 
     def apply_template(self, template_path):
         """Áp dụng template lên collage."""
-        template = cv2.imread(template_path, cv2.IMREAD_UNCHANGED)
-        if template is not None and self.collage_image is not None:
-            self.merged_image = overlay_images(self.collage_image.copy(), template)
-            self.update_template_preview()
+        if self.collage_image is None:
+            return
+        ready = self.template_previews.get(template_path)
+        if ready is not None:
+            self.merged_image = ready
+        else:
+            h, w = self.collage_image.shape[:2]
+            compositor = self.template_cache.compositor(template_path, (w, h))
+            if compositor is None:
+                return
+            # Ghi đè vào buffer dùng chung thay vì cấp phát ảnh mới
+            with perf_monitor.timer("render.template"):
+                self.merged_buffer = compositor.composite(self.collage_image, out=self.merged_buffer)
+            self.merged_image = self.merged_buffer
+        self.selected_template = template_path
+        self.update_template_preview()
 
     def use_no_template(self):
         """Không sử dụng template."""
         self.merged_image = self.collage_image.copy()
+        self.selected_template = None
         self.go_to_confirm()
 
     def go_to_confirm(self):
@@ -1186,25 +3628,21 @@ class PhotoboothApp(QMainWindow):
         
         # Hiển thị preview cuối
         if self.merged_image is not None:
-            qt_img = convert_cv_qt(self.merged_image)
-            scaled = qt_img.scaled(
-                self.final_preview_label.size(), 
-                Qt.KeepAspectRatio, 
-                Qt.SmoothTransformation
-            )
-            self.final_preview_label.setPixmap(scaled)
+            pixmap = self.preview_converter.to_pixmap(self.merged_image, self.final_preview_label.size())
+            self.final_preview_label.setPixmap(pixmap)
         
         self.stacked.setCurrentIndex(6)
 
     def accept_and_print(self):
-        """Đồng ý và tiến hành in ảnh."""
+        """Đồng ý và đưa ảnh vào hàng đợi lưu/in chạy nền."""
         if self.merged_image is None:
             return
         
-        # Kiểm tra máy in
-        printer_ok, printer_info = check_printer_available()
+        # Kiểm tra máy in (trạng thái đã được dò sẵn ở luồng nền)
+        printer_ok, printer_info = self.printer_service.status()
         
         if not printer_ok:
+            self.printer_service.refresh()
             QMessageBox.warning(
                 self, 
                 "⚠️ MÁY IN CHƯA ĐƯỢC KẾT NỐI",
@@ -1213,46 +3651,81 @@ class PhotoboothApp(QMainWindow):
             )
             return
         
-        # Lưu file
-        timestamp = time.strftime("%Y%m%d-%H%M%S")
-        filename = f"photo_{timestamp}.jpg"
+        # Tên file lưu; thêm mili giây vì job trước có thể chưa in xong khi khách sau bấm in
+        now = time.time()
+        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+        filename = f"photo_{timestamp}-{int(now * 1000) % 1000:03d}.jpg"
         filepath = os.path.join(OUTPUT_DIR, filename)
         
-        cv2.imwrite(filepath, self.merged_image)
+        # Bản in được render ở PRINT_SIZE từ ảnh gốc trên luồng nền,
+        # khách tiếp theo có thể bắt đầu ngay
+        sources = [self.captured_photos[i].copy() for i in sorted(self.selected_photo_indices)]
+        render = functools.partial(render_collage, sources, self.selected_layout, PRINT_SIZE,
+                                   self.template_cache, self.selected_template)
+        job = PrintJob(filepath, render=render, session=self.capture_session_id)
+        self.session_print_job = job.id
+        self.print_queue.submit(job)
+        
+        QMessageBox.information(
+            self,
+            "✅ ĐANG IN ẢNH",
+            f"Ảnh đang được gửi đến máy in: {printer_info}\n\n"
+            f"File sẽ được lưu: {filename}\n\n"
+            "Vui lòng chờ trong giây lát..."
+        )
         
-        # Cập nhật carousel với ảnh mới
-        self.gallery_photos = load_sample_photos()
-        self.load_carousel_photos()
+        # Reset về màn hình bắt đầu sau khi in
+        QTimer.singleShot(3000, self.reset_all)
+
+    def on_print_job_updated(self, job):
+        """Cập nhật gallery và dòng trạng thái khi job in đổi trạng thái (job là PrintJobStatus)."""
+        filename = os.path.basename(job.filepath)
+        state = job.state
+        if state == PrintJob.SPOOLING and job.attempts == 1:
+            # File đã được ghi xong, thêm vào carousel
+            self.add_gallery_photo(job.filepath, job.image)
+        
+        if state == PrintJob.QUEUED:
+            text = f"🖨️ {filename}: đang chờ..."
+        elif state == PrintJob.RENDERING:
+            text = f"🖨️ {filename}: đang dựng ảnh in..."
+        elif state == PrintJob.ENCODING:
+            text = f"🖨️ {filename}: đang lưu ảnh..."
+        elif state == PrintJob.SPOOLING:
+            text = f"🖨️ {filename}: đang gửi máy in (lần {job.attempts})..."
+        elif state == PrintJob.DONE:
+            text = f"✅ {filename}: đã gửi đến máy in {job.printer}"
+        else:
+            text = f"❌ {filename}: in lỗi - {job.error}"
+        self.print_status_label.setText(text)
         
-        # In ảnh
-        try:
-            os.startfile(filepath, "print")
-            QMessageBox.information(
-                self,
-                "✅ ĐANG IN ẢNH",
-                f"Ảnh đã được gửi đến máy in: {printer_info}\n\n"
-                f"File đã lưu: {filename}\n\n"
-                "Vui lòng chờ trong giây lát..."
-            )
-            
-            # Reset về màn hình bắt đầu sau khi in
-            QTimer.singleShot(3000, self.reset_all)
-            
-        except Exception as e:
-            QMessageBox.critical(
-                self,
-                "❌ LỖI IN ẢNH",
-                f"Không thể in ảnh: {str(e)}"
-            )
+        if state in (PrintJob.DONE, PrintJob.FAILED) and job.session is not None:
+            # Phiên của job kết thúc khi bản in xong (kể cả khi khách sau đã bắt đầu),
+            # để log có cả thời gian dựng, lưu và gửi máy in
+            self.end_perf_session(job.session, outcome=state, print_attempts=job.attempts)
+
+    def end_perf_session(self, session_id, **info):
+        """Ghi thống kê hiệu năng của phiên chụp session_id vào log."""
+        stats = self.camera_worker.stats()
+        perf_monitor.end_session(session_id, camera_fps=round(stats.get("fps", 0), 1),
+                                 frames_dropped=stats.get("dropped", 0), **info)
 
     def reset_all(self):
         """Reset toàn bộ về trạng thái ban đầu."""
+        if self.session_print_job is None:
+            # Khách bỏ ngang (không in): đóng phiên ngay
+            self.end_perf_session(self.capture_session_id, outcome="abandoned")
+        self.capture_scheduler.stop()
+        self.camera_worker.cancel_captures()
         self.state = "START"
-        self.captured_photos = []
+        self.captured_photos.clear()
+        self.clear_speculative()
         self.selected_photo_indices = []
         self.selected_frame_count = 0
+        self.selected_layout = None
         self.collage_image = None
         self.merged_image = None
+        self.selected_template = None
         self.payment_confirmed = False
         self.selected_price_type = 0
         
@@ -1261,24 +3734,32 @@ class PhotoboothApp(QMainWindow):
 
     def closeEvent(self, event):
         """Cleanup khi đóng app."""
-        self.camera_timer.stop()
-        self.countdown_timer.stop()
-        if hasattr(self, 'carousel1'):
-            self.carousel1.scroll_timer.stop()
-        if hasattr(self, 'carousel2'):
-            self.carousel2.scroll_timer.stop()
-        self.cap.release()
+        QApplication.instance().removeEventFilter(self)
+        self.idle_timer.stop()
+        self.camera_worker.stop()
+        self.print_queue.stop()
+        self.task_runner.shutdown()
+        self.printer_service.stop()
+        self.capture_scheduler.stop()
+        self.animation_clock.stop()
+        self.camera_worker.release()
         event.accept()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    startup = StartupReport(_IMPORT_START)
+    startup.mark("import thư viện")
     ensure_directories()
+    startup.mark("thư mục, ảnh mẫu")
     app = QApplication(sys.argv)
     
     # Set font mặc định
     font = QFont("Segoe UI", 12)
     app.setFont(font)
+    startup.mark("QApplication")
     
-    window = PhotoboothApp()
+    window = PhotoboothApp(startup)
     window.show()
+    startup.mark("hiện cửa sổ")
     sys.exit(app.exec_())